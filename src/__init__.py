@@ -27,3 +27,5 @@ from version import VERSION
 from proxy import Player
 from common import *
 from config import config
+from thumbnail import thumbnail
+from playlist import Playlist
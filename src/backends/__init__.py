@@ -23,22 +23,21 @@
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 # -----------------------------------------------------------------------------
 
-__all__ = ['config']
+__all__ = ['config', 'BACKENDS']
 
-import os
-import sys
+import logging
 
-config = []
+# Backends shipped with kaa.popcorn.  Each one is a subpackage providing a
+# config module and an import_backend() function.  Backends living outside
+# of kaa.popcorn are registered through the manager instead.
+BACKENDS = ('mplayer', 'null')
 
-backends_dir = os.path.dirname(__file__)
-for backend in os.listdir(backends_dir):
-    dirname = os.path.join(backends_dir, backend)
-    if not os.path.isdir(dirname):
-        continue
+config = []
 
+for backend in BACKENDS:
     try:
         # import the backend config
-        exec('from %s.config import config as c' % backend)
+        c = __import__('%s.config' % backend, globals(), locals(), ['config'], 1).config
         config.append((backend, c))
     except ImportError:
-        continue
+        logging.getLogger('popcorn').exception('Failed to load config for backend %s', backend)
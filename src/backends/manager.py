@@ -23,18 +23,21 @@
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 # -----------------------------------------------------------------------------
 
-__all__ = [ 'get_player_class', 'get_all_players' ]
+__all__ = [ 'get_player_class', 'get_all_players', 'register' ]
 
 # python imports
 import os
 import logging
 
-# kaa imports
-import kaa.metadata
-
 # kaa.popcorn imports
 from ..common import *
 from ..config import config
+from . import BACKENDS
+
+# Entry point group through which backends outside of kaa.popcorn are
+# discovered.  An entry point must refer to a function behaving like the
+# import_backend() function of the builtin backends.
+ENTRY_POINT_GROUP = 'kaa.popcorn.backends'
 
 # internal list of players
 _players = {}
@@ -43,38 +46,96 @@ _backends_imported = False
 # get logging object
 log = logging.getLogger('popcorn.manager')
 
+
+def register(player_id, player, capabilities):
+    """
+    Registers a backend.
+
+    @param player_id: name of the backend, as used for the player argument of
+        Player.open() and the preferred config option.
+    @param player: the backend class, or a 'module:Class' string naming it.
+        In the latter case, the module is only imported once the backend is
+        selected to play something.
+    @param capabilities: a function returning the tuple (caps, schemes,
+        extensions, codecs, video drivers), or that tuple itself if the
+        backend can declare its capabilities statically.  If caps is None,
+        the backend is not usable.
+    """
+    if player_id in _players:
+        return log.warning("Player '%s' already registered", player_id)
+
+    # FIXME: we just defer fetching the capabilities until the first time
+    # a player is needed, but we should do this in a thread when the system
+    # is idle.
+    _players[player_id] = {
+        'class': player,
+        'callback': capabilities,
+        'loaded': False
+    }
+
+
 def import_backends():
     global _backends_imported
     if _backends_imported:
         return
 
-    for backend in config:
-        if getattr(getattr(config, backend), 'enabled', False):
-            try:
-                # import the backend and register it.
-                exec('from %s import import_backend' % backend)
-                player_id, cls, get_caps_callback = import_backend()
-            except ImportError, e:
-                continue
-            if player_id in _players:
-                return log.warning("Player '%s' already registered", player_id)
-
-            # set player id (which is probably the same as the backend 
-            # dir name, but it's up to the backend).
-            cls._player_id = player_id
-
-            # FIXME: we just defer calling get_caps_callback until the first time
-            # a player is needed, but we should do this in a thread when the system
-            # is idle.
-            _players[player_id] = {
-                'class': cls,
-                'callback': get_caps_callback,
-                'loaded': False
-            }
-            
     # This function only ever needs to be called once.
     _backends_imported = True
 
+    for backend in BACKENDS:
+        if not getattr(getattr(config, backend, None), 'enabled', False):
+            continue
+        try:
+            # Only the lightweight backend package is imported here, the
+            # player module is loaded when the backend is selected.
+            module = __import__(backend, globals(), locals(), ['import_backend'], 1)
+        except ImportError:
+            log.exception('Failed to import backend %s', backend)
+            continue
+        register(*module.import_backend())
+
+    try:
+        import pkg_resources
+    except ImportError:
+        return
+    for entry in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+        # Out-of-tree backends usually have no config of their own, so
+        # they are enabled unless the config says otherwise.
+        if not getattr(getattr(config, entry.name, None), 'enabled', True):
+            continue
+        try:
+            register(*entry.load()())
+        except Exception:
+            log.exception('Failed to load backend %s from %s', entry.name, entry.module_name)
+
+
+def _load_class(player_id):
+    """
+    Returns the class of the given player, importing its module if it was
+    registered by name.  Returns None if the import fails.
+    """
+    player = _players[player_id]
+    cls = player['class']
+    if player.get('imported'):
+        return cls
+    if isinstance(cls, basestring):
+        modname, clsname = cls.split(':')
+        try:
+            cls = getattr(__import__(modname, {}, {}, [clsname]), clsname)
+        except (ImportError, AttributeError):
+            log.exception('Failed to load backend %s', player_id)
+            del _players[player_id]
+            return None
+        player['class'] = cls
+
+    # set player id (which is probably the same as the backend
+    # dir name, but it's up to the backend).
+    cls._player_id = player_id
+    # Note: cls._player_caps are without the rating!
+    cls._player_caps = [ k for k, v in player['caps'].items() if k and v ]
+    player['imported'] = True
+    return cls
+
 
 def get_player_class(media, caps=None, exclude=None, force=None, cfg=None):
     """
@@ -86,6 +147,8 @@ def get_player_class(media, caps=None, exclude=None, force=None, cfg=None):
     player is found, otherwise None.
     """
     import_backends()
+    # Deferred because it's expensive to import and only needed here.
+    import kaa.metadata
 
     if cfg is None:
         # No user-overridden config specified, use global default.
@@ -96,7 +159,8 @@ def get_player_class(media, caps=None, exclude=None, force=None, cfg=None):
         if _players[player_id]['loaded']:
             continue
 
-        player_caps, schemes, exts, codecs, vo = _players[player_id]['callback']()
+        callback = _players[player_id]['callback']
+        player_caps, schemes, exts, codecs, vo = callback() if callable(callback) else callback
 
         if player_caps is None:
             # failed to load, ignore this player
@@ -116,17 +180,13 @@ def get_player_class(media, caps=None, exclude=None, force=None, cfg=None):
             'loaded': True,
         })
 
-        cls = _players[player_id]['class']
-        # Note: cls._player_caps are without the rating!
-        cls._player_caps = [ k for k, v in player_caps.items() if k and v ]
-
     if force != None and force in _players:
         player = _players[force]
         if media.scheme not in player['schemes']:
             return None
         # return forced player, no matter if the other
         # capabilities match or not
-        return player['class']
+        return _load_class(force)
 
     ext = os.path.splitext(media.url)[1]
     if ext:
@@ -191,12 +251,16 @@ def get_player_class(media, caps=None, exclude=None, force=None, cfg=None):
 
         log.debug('%s rating: %s', player_id, rating)
         if not choice or choice[1] < rating:
-            choice = player, rating
+            choice = player_id, rating
 
     if not choice:
         return None
 
-    return choice[0]['class']
+    cls = _load_class(choice[0])
+    if not cls:
+        # Backend failed to load and is now unregistered, try the others.
+        return get_player_class(media, caps, exclude, force, cfg)
+    return cls
 
 
 def get_all_players():
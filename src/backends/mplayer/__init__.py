@@ -62,6 +62,9 @@ def get_capabilities():
 
     # TODO: set CAP_VISUALIZATION if we have libvisual
 
+    # Frames can be written to shared memory through a yuv4mpeg fifo.
+    capabilities[CAP_VO_SHM] = 'yuv4mpeg' in info['video_drivers']
+
     schemes = [ 'file', 'vcd', 'cdda', 'cue', 'tivo', 'http', 'mms',
                 'rtp', 'rtsp', 'ftp', 'udp', 'sdp', 'dvd', 'fifo' ]
 
@@ -79,7 +82,7 @@ def get_capabilities():
 
 def import_backend():
     """
-    Return player name, class and capability function.
+    Return player name, class and capability function.  The class is given
+    by name, so the player module is only imported when it's needed.
     """
-    from player import MPlayer
-    return ('mplayer', MPlayer, get_capabilities)
+    return ('mplayer', __name__ + '.player:MPlayer', get_capabilities)
@@ -0,0 +1,338 @@
+# -*- coding: iso-8859-1 -*-
+# $Id$
+# -----------------------------------------------------------------------------
+# identify.py - MPlayer -identify parsing, media scanner and result store
+# -----------------------------------------------------------------------------
+# kaa.popcorn - Generic Player API
+# Copyright (C) 2008 Jason Tackaberry, Dirk Meyer
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+# -----------------------------------------------------------------------------
+
+"""
+Identifying a file means running MPlayer with -identify on it and parsing
+the ID_* lines into a stream info dict, as the backend does in open().
+
+For large libraries, scan() identifies many files with several concurrent
+MPlayer children, each identifying a batch of files, and stores the results
+in an IdentifyStore, an SQLite database.  If mplayer.identify.store names
+that database, the backend's open() takes the stream info from it instead
+of running MPlayer, as long as the file is unchanged:
+
+    store = IdentifyStore(kaa.popcorn.config.mplayer.identify.store)
+    yield scan(filenames, store)
+"""
+
+__all__ = [ 'STREAM_INFO_MAP', 'RE_ERROR', 'parse_line', 'identify', 'identify_batch',
+            'IdentifyStore', 'get_store', 'scan' ]
+
+# python imports
+import os
+import re
+import json
+import time
+import logging
+
+# kaa imports
+import kaa
+import kaa.utils
+
+# kaa.popcorn imports
+from ...common import PlayerError
+from ...utils import cpu_count
+from config import config
+from utils import escalate
+
+# get logging object
+log = logging.getLogger('popcorn.mplayer')
+
+RE_ERROR = re.compile(r'^(File not found|Failed to open|MPlayer interrupt|Unknown option|Error parsing|FATAL:)')
+
+STREAM_INFO_MAP = {
+    'VIDEO_FORMAT': ('vfourcc', str),
+    'VIDEO_CODEC': ('vcodec', str),
+    'VIDEO_BITRATE': ('vbitrate', int),
+    'VIDEO_WIDTH': ('width', int),
+    'VIDEO_HEIGHT': ('height', int),
+    'VIDEO_FPS': ('fps', float),
+    'VIDEO_ASPECT': ('aspect', float),
+    'AUDIO_FORMAT': ('afourcc', str),
+    'AUDIO_CODEC': ('acodec', str),
+    'AUDIO_BITRATE': ('abitrate', int),
+    'AUDIO_NCH': ('channels', int),
+    'LENGTH': ('length', float),
+    'FILENAME': ('uri', str),
+    'SEEKABLE': ('seekable', bool),
+}
+
+# Arguments to identify a file without playing it.
+IDENTIFY_ARGS = '-nolirc -nojoystick -identify -vo null -ao null -frames 0 -nocache -demuxer lavf'
+
+# Open IdentifyStore objects, keyed by file name.
+_stores = {}
+
+
+def _unicode(path):
+    return path if isinstance(path, unicode) else path.decode('utf-8', 'replace')
+
+
+def _decode(info):
+    # JSON gives unicode, but the backend's stream info holds str.
+    return dict((str(k), v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in info.items())
+
+
+def parse_line(line, info):
+    """
+    Parses an ID_* line of MPlayer's -identify output into the info dict.
+    Returns True if the line held stream info.
+    """
+    attr, value = line.rstrip().split('=', 1)
+    attr, tp = STREAM_INFO_MAP.get(attr[3:], (None, None))
+    if attr:
+        info[attr] = tp(value)
+        return True
+    return False
+
+
+@kaa.coroutine()
+def identify_batch(filenames, mplayer=None):
+    """
+    Identifies several files with one MPlayer child, which saves the cost of
+    spawning a child per file.
+
+    @param filenames: files to identify
+    @param mplayer: MPlayer executable; if None, mplayer.path or $PATH
+    @returns: InProgress finished with a list of (info, error) tuples, one
+        per file: the stream info dict and None, or None and an error message
+
+    MPlayer prints "Playing <file>." before the output for each file, in the
+    order given, so the ID_* and error lines are attributed to the file that
+    was announced last.  If the child dies on a file, or hangs on it (no
+    output for mplayer.watchdog.startup seconds, after which it is killed as
+    by the backend's watchdog), that file fails and the files after it are
+    identified by a new child.
+    """
+    mplayer = mplayer or config.path or kaa.utils.which('mplayer')
+    results = []
+    while len(results) < len(filenames):
+        todo = filenames[len(results):]
+        # Output of each file announced so far: [info, errors]
+        output = []
+        # Time of the last output line, and the watchdog's escalation step
+        # once the child is considered hung.
+        watch = { 'line': time.time(), 'stage': 0 }
+
+        def handle_line(line):
+            watch['line'] = time.time()
+            line = line.rstrip()
+            if line.startswith('Playing ') and line.endswith('.') and len(output) < len(todo):
+                output.append(({}, []))
+            elif not output:
+                pass
+            elif line.startswith('ID_') and '=' in line:
+                parse_line(line, output[-1][0])
+            elif RE_ERROR.match(line):
+                output[-1][1].append(line)
+
+        def check():
+            if watch['stage']:
+                watch['stage'] += 1
+                return escalate(child, watch['stage'] - 1)
+            if time.time() - watch['line'] > config.watchdog.startup:
+                log.error('Watchdog: MPlayer hung identifying %s', todo[max(len(output) - 1, 0)])
+                watch['stage'] = 1
+                watchdog.start(config.watchdog.escalate)
+                return check()
+
+        # Options first: MPlayer applies options given after a file name to
+        # that file only.
+        child = kaa.Process(mplayer)
+        child.delimiter = ['\r', '\n']
+        child.signals['readline'].connect(handle_line)
+        watchdog = kaa.Timer(check)
+        # Unlike the InProgress returned by start(), 'finished' is only
+        # emitted once all output was read.
+        finished = kaa.inprogress(child.signals['finished'])
+        child.start(IDENTIFY_ARGS.split() + todo)
+        if config.watchdog.enabled:
+            watchdog.start(config.watchdog.startup / 4.0)
+        try:
+            yield finished
+        finally:
+            watchdog.stop()
+
+        died = 'MPlayer %s while identifying %%s' % ('hung' if watch['stage'] else 'exited')
+        for n, (info, errors) in enumerate(output):
+            if watch['stage'] and n == len(output) - 1:
+                # The file the child hung on, its info may be incomplete.
+                results.append((None, died % todo[n]))
+            elif [ key for key in info if key != 'uri' ]:
+                results.append((info, None))
+            elif errors or n < len(output) - 1:
+                results.append((None, errors[0] if errors else 'No stream info for %s' % todo[n]))
+            else:
+                # Last file announced without any output: the child died on it.
+                results.append((None, died % todo[n]))
+        if not output:
+            # The child died (or hung) before even the first file.
+            results.append((None, died % todo[0]))
+    yield results
+
+
+@kaa.coroutine()
+def identify(filename, mplayer=None):
+    """
+    Identifies a file with its own MPlayer child.
+
+    @param filename: file to identify
+    @param mplayer: MPlayer executable; if None, mplayer.path or $PATH
+    @returns: InProgress finished with the stream info dict, or raising a
+        PlayerError if MPlayer can't open the file
+    """
+    (info, error), = yield identify_batch([filename], mplayer)
+    if error:
+        raise PlayerError(error)
+    yield info
+
+
+class IdentifyStore(object):
+    """
+    SQLite database of stream info dicts, keyed by file name.  An entry is
+    only valid as long as size and modification time of the file match.
+    Failures are stored too, so broken files are not identified again.
+    """
+    def __init__(self, filename):
+        import sqlite3
+        self.filename = filename
+        self._db = sqlite3.connect(filename)
+        self._db.execute('CREATE TABLE IF NOT EXISTS identify (path TEXT PRIMARY KEY, '
+                         'size INTEGER, mtime REAL, info TEXT, error TEXT)')
+        # Number of changes not yet committed.
+        self._pending = 0
+
+
+    def lookup(self, path, st=None):
+        """
+        Returns (info, error) stored for the file, or None if there is no
+        valid entry.  st is the file's os.stat() result, if already known.
+        """
+        path = os.path.abspath(path)
+        st = st or os.stat(path)
+        row = self._db.execute('SELECT size, mtime, info, error FROM identify WHERE path=?',
+                               (_unicode(path),)).fetchone()
+        if not row or row[0] != st.st_size or row[1] != st.st_mtime:
+            return None
+        return (_decode(json.loads(row[2])) if row[2] else None), row[3]
+
+
+    def get(self, path):
+        """
+        Returns the stream info for the file, or None if the file was not
+        identified successfully or changed since.
+        """
+        try:
+            entry = self.lookup(path)
+        except OSError:
+            return None
+        return entry[0] if entry else None
+
+
+    def put(self, path, st, info, error=None):
+        """
+        Stores the stream info (or the error message) for the file.  The
+        change is committed in batches, see commit().
+        """
+        self._db.execute('INSERT OR REPLACE INTO identify VALUES (?, ?, ?, ?, ?)',
+                         (_unicode(os.path.abspath(path)), st.st_size, st.st_mtime,
+                          json.dumps(info) if info else None, error))
+        self._pending += 1
+        if self._pending >= 100:
+            self.commit()
+
+
+    def commit(self):
+        self._db.commit()
+        self._pending = 0
+
+
+def get_store(filename):
+    """
+    Returns the IdentifyStore for the given database file, opening it on
+    first use.
+    """
+    if filename not in _stores:
+        _stores[filename] = IdentifyStore(filename)
+    return _stores[filename]
+
+
+@kaa.coroutine()
+def scan(paths, store, jobs=0, batch=0, mplayer=None):
+    """
+    Identifies files concurrently and stores the results.
+
+    @param paths: iterable of file names
+    @param store: IdentifyStore for the results
+    @param jobs: number of concurrent MPlayer children; if 0, the value of
+        mplayer.identify.jobs, and if that is 0, the number of CPUs
+    @param batch: maximum number of files per child (see identify_batch());
+        if 0, the value of mplayer.identify.batch
+    @param mplayer: MPlayer executable; if None, mplayer.path or $PATH
+    @returns: InProgress finished with a dict counting the files
+        'identified', 'failed' and 'skipped' (unchanged since the last scan)
+    """
+    jobs = jobs or config.identify.jobs or cpu_count()
+    batch = batch or config.identify.batch
+    stats = { 'identified': 0, 'failed': 0, 'skipped': 0 }
+    # Shared by all workers, so each file is taken by one of them.
+    paths = iter(paths)
+
+    def take():
+        """
+        Returns the next (path, stat) tuples that need identifying.
+        """
+        files = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError, e:
+                log.warning('Unable to scan %s: %s', path, e)
+                stats['failed'] += 1
+                continue
+            if store.lookup(path, st):
+                stats['skipped'] += 1
+                continue
+            files.append((path, st))
+            if len(files) >= batch:
+                break
+        return files
+
+    @kaa.coroutine()
+    def worker():
+        files = take()
+        while files:
+            results = yield identify_batch([ path for path, st in files ], mplayer)
+            for (path, st), (info, error) in zip(files, results):
+                store.put(path, st, info, error)
+                stats['failed' if error else 'identified'] += 1
+            files = take()
+
+    try:
+        yield kaa.InProgressAll(*[ worker() for i in range(jobs) ])
+    finally:
+        store.commit()
+    log.info('Scan finished: %(identified)d identified, %(failed)d failed, %(skipped)d skipped', stats)
+    yield stats
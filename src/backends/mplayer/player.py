@@ -29,29 +29,23 @@ __all__ = [ 'MPlayer' ]
 import logging
 import re
 import os
-import stat
-import string
+import signal
+import time
+import tempfile
 
 # kaa imports
 import kaa
 import kaa.utils
+import kaa.metadata
 from kaa.utils import property
 
-try:
-    from kaa.display import X11Window
-except ImportError:
-    class X11Window(object):
-        pass
-
-try:
-    from kaa.candy import Stage as CandyStage
-except ImportError:
-    class CandyStage(object):
-        pass
-
 # kaa.popcorn imports
 from ...common import *
+from ...utils import apply_process_policy, lazy_isinstance
+from ...shm import FrameRing
 from utils import *
+from transcript import Recorder
+from identify import RE_ERROR, parse_line, get_store
 
 # get logging object
 log = logging.getLogger('popcorn.mplayer')
@@ -59,25 +53,21 @@ log = logging.getLogger('popcorn.mplayer')
 # Global constants
 # regexp whose groups() is (vpos, apos, speed)
 RE_STATUS = re.compile(r'(?:V:\s*([\d.]+)|A:\s*([\d.]+)\s\W)(?:.*\s([\d.]+x))?')
-RE_ERROR = re.compile(r'^(File not found|Failed to open|MPlayer interrupt|Unknown option|Error parsing|FATAL:)')
-
-STREAM_INFO_MAP = {
-    'VIDEO_FORMAT': ('vfourcc', str),
-    'VIDEO_CODEC': ('vcodec', str),
-    'VIDEO_BITRATE': ('vbitrate', int),
-    'VIDEO_WIDTH': ('width', int),
-    'VIDEO_HEIGHT': ('height', int),
-    'VIDEO_FPS': ('fps', float),
-    'VIDEO_ASPECT': ('aspect', float),
-    'AUDIO_FORMAT': ('afourcc', str),
-    'AUDIO_CODEC': ('acodec', str),
-    'AUDIO_BITRATE': ('abitrate', int),
-    'AUDIO_NCH': ('channels', int),
-    'LENGTH': ('length', float),
-    'FILENAME': ('uri', str),
-    'SEEKABLE': ('seekable', bool),
+RE_CACHE_FILL = re.compile(r'Cache fill:\s*([\d.]+)%')
+
+# Chroma subsampling of yuv4mpeg streams: fourcc and the size of both chroma
+# planes together, as function of width and height.
+Y4M_CHROMA = {
+    '420': ('I420', lambda w, h: ((w + 1) / 2) * ((h + 1) / 2) * 2),
+    '422': ('Y42B', lambda w, h: ((w + 1) / 2) * h * 2),
+    '444': ('Y444', lambda w, h: w * h * 2),
+    'mon': ('Y800', lambda w, h: 0),
 }
 
+# MPlayer children that were stopped with SIGTERM but have not yet been
+# reaped.  We hold a reference until they exit.
+_reaping = set()
+
 
 class MPlayer(object):
 
@@ -92,7 +82,25 @@ class MPlayer(object):
 
         # A kaa.Process object if mplayer is running.
         self._child = None
+        # Transcript Recorder for the current child if mplayer.transcript
+        # is set.
+        self._recorder = None
+        # Watchdog for hung children, see _watchdog_check().  _last_line is
+        # the time the child last produced output (None if it has not yet),
+        # _watchdog_progress the time it last made progress opening or
+        # starting the stream, and _watchdog_stage is the escalation step
+        # once the child is considered hung (0 while it is healthy).
+        self._watchdog = kaa.WeakTimer(self._watchdog_check)
+        self._watchdog_progress = 0
+        self._watchdog_stage = 0
+        self._last_line = None
+        # Fifo MPlayer writes yuv4mpeg frames to if CAP_VO_SHM was requested,
+        # and the FrameRing they are copied into.  See _vo_shm_start().
+        self._vo_shm_fifo = None
+        self._frames = None
         self._mp_cmd = proxy._config.mplayer.path
+        # Seeks ahead (or back) while in trick-play, see _speed_apply().
+        self._trickplay_timer = kaa.WeakTimer(self._trickplay_step)
         self._reset_stream()
 
         # TODO: use these.
@@ -128,17 +136,18 @@ class MPlayer(object):
         if self._state != value:
             log.info('State change: %s -> %s', self._state, value)
             if value == STATE_NOT_RUNNING:
-                # MPlayer destroys the window on exit so it's no longer valid.  Set
-                # it to none now so the proxy doesn't try to do anything with it,
-                # and so that we recreate it on the next play().
-                self._proxy._window_inner = None
-                if isinstance(self._proxy.window, X11Window):
+                # MPlayer destroys the window on exit so it's no longer valid.
+                # Release it now so the proxy doesn't try to do anything with
+                # it.  The next play() acquires a new one.
+                self._proxy._window_release()
+                self._vo_shm_stop()
+                if lazy_isinstance(self._proxy._window, 'kaa.display', 'X11Window'):
                     # Hide the window.  Again, should we do this automatically or
                     # use a property?  XXX: note if we don't do it automatically,
                     # we will need to explicitly call proxy._window_layot() after
                     # playing because there will be no resize event to do that
                     # for us otherwise.
-                    self._proxy.window.hide()
+                    self._proxy._window.hide()
 
             self._state = value
 
@@ -217,6 +226,31 @@ class MPlayer(object):
         if self._child:
             self._slave_cmd('set_property deinterlace %d' % int(value))
 
+    @property
+    def speed(self):
+        """
+        Playback speed, 1.0 being normal speed.  Negative values play
+        backward.  Speeds above mplayer.trickplay.threshold, and all negative
+        speeds, are done by trick-play: the stream is played muted at
+        normal speed, and seeked ahead (or back) at regular intervals, which
+        costs no more CPU time than normal playback.
+        """
+        return self._stream_info.get('speed', 1.0)
+
+    @speed.setter
+    def speed(self, value):
+        self._stream_info['speed'] = float(value)
+        if self._child and self.state in (STATE_PLAYING, STATE_PAUSED):
+            self._speed_apply()
+
+    @property
+    def frames(self):
+        """
+        FrameRing holding the decoded frames if the stream was opened with
+        CAP_VO_SHM, otherwise None.  Available once the first frame arrived.
+        """
+        return self._frames
+
 
     #########################################
     # Private Methods
@@ -225,6 +259,7 @@ class MPlayer(object):
         log.info('handle_child_exit %s', code)
         self._child.signals['finished'].disconnect(self._handle_child_exit)
         self._child = None
+        self._watchdog.stop()
         if self.state in (STATE_STARTING, STATE_PLAYING, STATE_PAUSED):
             # Child died when we didn't expect it to.  Adjust state now and
             # emit appropriate signals.
@@ -239,14 +274,77 @@ class MPlayer(object):
         self.state = STATE_NOT_RUNNING
 
 
+    def _trickplay(self, speed):
+        return speed < 0 or speed > self._proxy._config.mplayer.trickplay.threshold
+
+
+    def _speed_apply(self):
+        """
+        Makes the child play at the speed property's value.
+        """
+        speed = self.speed
+        if self._trickplay(speed):
+            # Trick-play positions are computed from here at the new speed.
+            self._trickplay_origin = self._position, time.time()
+            if not self._trickplay_timer.active:
+                log.info('Trick-play at %.2fx', speed)
+                self._slave_cmd('speed_set 1')
+                # The answer (see _handle_child_line()) tells whether the
+                # stream was muted before, to restore that afterwards.
+                self._trickplay_mute = None
+                self._slave_cmd('get_property mute')
+                self._slave_cmd('mute 1')
+                self._trickplay_timer.start(self._proxy._config.mplayer.trickplay.interval)
+            return
+        if self._trickplay_timer.active:
+            self._trickplay_timer.stop()
+            self._trickplay_target = None
+            self._slave_cmd('mute %d' % bool(self._trickplay_mute))
+        self._slave_cmd('speed_set %.2f' % speed)
+
+
+    def _trickplay_step(self):
+        if not self._child or self.state != STATE_PLAYING or self._waiting_for_seek:
+            # Paused or seeked by the user: continue from wherever playback
+            # is at the next step.
+            self._trickplay_origin = None
+            return
+        if self._trickplay_target is not None:
+            # Previous seek not done yet (slow media), don't pile up more.
+            return
+        if not self._trickplay_origin:
+            self._trickplay_origin = self._position, time.time()
+            return
+        # Seek to where the stream would be at this speed, rather than by a
+        # step relative to the reported position, which lags behind the
+        # seeks and would make errors add up.
+        start, t0 = self._trickplay_origin
+        target = start + self.speed * (time.time() - t0)
+        if target <= 0:
+            # Rewound to the beginning, continue at normal speed from there.
+            self._slave_cmd('seek 0 2')
+            self.speed = 1.0
+        else:
+            self._trickplay_target = target
+            self._slave_cmd('seek %.2f 2' % target)
+
+
     def _slave_cmd(self, cmd, *args):
         output = 'pausing_keep %s %s' % (cmd, ' '.join([ str(x) for x in args]))
         log.info('Slave cmd: %s', output)
         self._child.write(output.strip() + '\n')
+        if self._recorder:
+            self._recorder.command(output.strip())
 
 
     def _handle_child_line(self, line):
         #log.debug(line)
+        self._last_line = time.time()
+        if self._state == STATE_OPENING:
+            if line.startswith('ID_'):
+                self._watchdog_progress = self._last_line
+        elif line.startswith('V:') or line.startswith('A:') or line.startswith('Cache fill:'):
+            self._watchdog_progress = self._last_line
         if line.startswith('V:') or line.startswith('A:'):
             m = RE_STATUS.search(line)
             if not m:
@@ -255,6 +353,36 @@ class MPlayer(object):
 
             old = self._position
             self._position = float((m.group(1) or m.group(2)).replace(',', '.'))
+            if self._trickplay_target is not None:
+                # Arrived at the target, or at a keyframe near it.
+                jumped = self._position < old or self._position - old > 1
+                if jumped or abs(self._position - self._trickplay_target) < 1:
+                    self._trickplay_target = None
+            if self.state != STATE_STARTING and not self._trickplay_timer.active:
+                # MPlayer shows the speed only if it isn't 1.
+                self._stream_info['speed'] = float(m.group(3)[:-1]) if m.group(3) else 1.0
+
+            if self._buffering is not None:
+                # Playing again, so the cache is filled.
+                if self._buffering < 100:
+                    self._proxy.signals['buffering'].emit(100.0)
+                self._buffering = None
+
+            if self._loop:
+                if self._position < self._loop[1]:
+                    self._loop_seeking = False
+                elif not self._loop_seeking:
+                    # Passed the end of the loop, one seek back to its start.
+                    self._loop_seeking = True
+                    self._slave_cmd('seek %.3f 2' % self._loop[0])
+
+            if self._frame_steps:
+                # Frame stepped by frame_step(), so MPlayer is still paused.
+                self._frame_steps -= 1
+                if not self._frame_steps:
+                    self._frame_step_done.finish(self._position)
+                self._proxy.signals['position-changed'].emit(old, self._position)
+                return
 
             if self._stream_changed and self.state != STATE_STARTING:
                 # Stream changed so emit.  We don't bother emitting if the
@@ -284,6 +412,8 @@ class MPlayer(object):
                     self._stream_info['deinterlace'] = True
 
                 self.state = STATE_PLAYING
+                if self._trickplay(self.speed):
+                    self._speed_apply()
                 self._stream_changed = False
                 self._proxy.signals['stream-changed'].emit()
                 self._proxy.signals['start'].emit()
@@ -293,16 +423,30 @@ class MPlayer(object):
 
 
         elif line.startswith('ID_PAUSED') or line.find('==  PAUSE  ==') >= 0:
-            self.state = STATE_PAUSED
-            self._proxy.signals['pause'].emit()
+            # MPlayer also reports this after each frame_step.
+            if self.state != STATE_PAUSED:
+                self.state = STATE_PAUSED
+                self._proxy.signals['pause'].emit()
 
         elif line.startswith('ID_') and '=' in line:
-            attr, value = line.rstrip().split('=', 1)
-            attr, tp = STREAM_INFO_MAP.get(attr[3:], (None, None))
-            if attr:
-                self._stream_info[attr] = tp(value)
+            if parse_line(line, self._stream_info):
                 self._stream_changed = True
 
+        elif line.startswith('Cache fill:'):
+            m = RE_CACHE_FILL.match(line)
+            if m:
+                progress = min(100.0 * float(m.group(1)) / self._cache_min, 100.0)
+                if self._buffering is None or int(progress) != int(self._buffering):
+                    self._buffering = progress
+                    self._proxy.signals['buffering'].emit(progress)
+
+        elif line.startswith('VO: [') or line.startswith('AO: ['):
+            # Video/audio output driver in use, e.g. "VO: [xv] 720x576 => ..."
+            self._drivers[line[:2]] = line[5:line.find(']')]
+
+        elif line.startswith('ANS_mute='):
+            self._trickplay_mute = line[9:].strip() == 'yes'
+
         elif line.startswith('EOF code'):
             self.state = STATE_STOPPING
 
@@ -333,6 +477,212 @@ class MPlayer(object):
         # stream-changed on the next status line.
         self._stream_changed = False
         self._error_message = None
+        # Output drivers reported by MPlayer, keyed on 'VO' and 'AO'.
+        self._drivers = {}
+        self._trickplay_timer.stop()
+        # (position, time) trick-play started at, the target of its seek
+        # while MPlayer hasn't arrived there (see _trickplay_step()), and
+        # whether the stream was muted before it started.
+        self._trickplay_origin = None
+        self._trickplay_target = None
+        self._trickplay_mute = None
+        # Number of frames still to be stepped by frame_step(), and the
+        # InProgress finished when they are.
+        self._frame_steps = 0
+        self._frame_step_done = None
+        # (start, end) of the segment set by loop(), and whether the seek back
+        # to its start was issued but MPlayer hasn't arrived there yet.
+        self._loop = None
+        self._loop_seeking = False
+        # Percentage of the cache MPlayer fills before it starts playing
+        # (MPlayer's default unless play() passes -cache-min), and the last
+        # progress emitted with the buffering signal, None if not buffering.
+        self._cache_min = 20.0
+        self._buffering = None
+
+
+    def _record(self, args, task):
+        """
+        Records a transcript of the current child session if the
+        mplayer.transcript config option names a directory.
+        """
+        self._recorder = None
+        directory = self._proxy._config.mplayer.transcript
+        if not directory:
+            return
+        filename = os.path.join(directory, '%s-%d-%s.txt.gz' % \
+                                (time.strftime('%Y%m%d-%H%M%S'), id(self), task))
+        try:
+            recorder = self._recorder = Recorder(filename, [self._mp_cmd] + args)
+        except IOError, e:
+            return log.warning('Unable to record transcript: %s', e)
+        log.info('Recording transcript to %s', filename)
+        # Connected before _handle_child_line() so the timestamps are taken
+        # when the line arrives.
+        self._child.signals['readline'].connect(recorder.output)
+        self._child.signals['finished'].connect(recorder.close)
+
+
+    def _vo_shm_start(self):
+        """
+        Creates the fifo MPlayer writes yuv4mpeg frames to and starts the
+        thread copying them into shared memory.  Returns the fifo's path.
+        """
+        self._frames = None
+        fifo = self._vo_shm_fifo = os.path.join(tempfile.mkdtemp(prefix='popcorn-'), 'frames.y4m')
+        os.mkfifo(fifo, 0600)
+        self._vo_shm_read(fifo, self._proxy._config.mplayer.shm.slots)
+        return fifo
+
+
+    def _vo_shm_stop(self):
+        """
+        Makes sure the reader thread terminates once the child is gone.
+        """
+        fifo, self._vo_shm_fifo = self._vo_shm_fifo, None
+        if fifo:
+            # If MPlayer died before opening the fifo, the reader is still
+            # blocked opening it.  Briefly opening it for writing wakes it up;
+            # otherwise this fails (nobody reading) or is harmless.
+            try:
+                os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+
+
+    @kaa.threaded()
+    def _vo_shm_read(self, fifo, slots):
+        """
+        Thread copying the frames of the yuv4mpeg stream from the fifo into a
+        new FrameRing until the stream ends.
+        """
+        fd = open(fifo, 'rb')
+        ring = None
+        try:
+            header = fd.readline().split()
+            if not header or header[0] != 'YUV4MPEG2':
+                return
+            params = dict((p[0], p[1:]) for p in header[1:])
+            width, height = int(params['W']), int(params['H'])
+            fourcc, chroma = Y4M_CHROMA.get(params.get('C', '420')[:3], Y4M_CHROMA['420'])
+            size = width * height + chroma(width, height)
+            ring = self._frames = FrameRing(slots, size, width, height, fourcc)
+            log.info('Reading %dx%d %s frames from %s', width, height, fourcc, fifo)
+            while fd.readline().startswith('FRAME'):
+                data = fd.read(size)
+                if len(data) < size:
+                    break
+                ring.write(data)
+        finally:
+            fd.close()
+            if ring:
+                ring.close()
+            os.unlink(fifo)
+            os.rmdir(os.path.dirname(fifo))
+
+
+    def _watchdog_start(self):
+        """
+        Starts watching the current child for missing output.
+        """
+        cfg = self._proxy._config.mplayer.watchdog
+        if not cfg.enabled:
+            return
+        self._watchdog_progress = time.time()
+        self._watchdog_stage = 0
+        self._last_line = None
+        # Polled finely enough that a hung child is killed within a second
+        # with the default heartbeat and escalate values.
+        self._watchdog.start(min(cfg.startup, cfg.heartbeat) / 10.0)
+
+
+    def _watchdog_check(self):
+        cfg = self._proxy._config.mplayer.watchdog
+        if not self._child:
+            return False
+        if self._watchdog_stage:
+            return self._watchdog_escalate()
+
+        now = time.time()
+        if self.state == STATE_OPENING and now - self._watchdog_progress > cfg.startup:
+            # MPlayer may well print its banner and then hang opening the file.
+            self._watchdog_fire('MPlayer did not identify the stream within %.1f seconds' % cfg.startup)
+        elif self.state == STATE_STARTING and now - self._watchdog_progress > cfg.start:
+            self._watchdog_fire('MPlayer did not start playback within %.1f seconds' % cfg.start)
+        elif self.state == STATE_PLAYING:
+            # Seeking on slow media (DVD, network file systems) may take a
+            # while without any status line.
+            seeking = self._waiting_for_seek or self._trickplay_target is not None
+            timeout = cfg.seek if seeking else cfg.heartbeat
+            if now - (self._last_line or self._watchdog_progress) > timeout:
+                self._watchdog_fire('MPlayer stopped responding for %.1f seconds' % timeout)
+
+
+    def _watchdog_fire(self, msg):
+        """
+        Child is considered hung.  Kill it and wake up anything waiting on it.
+        """
+        log.error('Watchdog: %s (state=%s)', msg, self.state)
+        self._error_message = msg
+        self._watchdog_stage = 1
+        self._watchdog_escalate()
+        self._watchdog.start(self._proxy._config.mplayer.watchdog.escalate)
+        # If play() is waiting for the stream to start, it will now handle
+        # the error.  If we are playing, _handle_child_exit() emits the error
+        # once the child is dead.
+        self._error_signal.emit(PlayerError(msg))
+
+
+    def _watchdog_escalate(self):
+        """
+        Escalation steps of the watchdog: quit command, SIGTERM, SIGKILL.
+        """
+        stage, self._watchdog_stage = self._watchdog_stage, self._watchdog_stage + 1
+        return escalate(self._child, stage)
+
+
+    def _can_fast_stop(self):
+        """
+        Returns True if the child can be killed without a graceful quit, which
+        is the case if all output drivers it reported need no teardown.
+        """
+        cfg = self._proxy._config.mplayer.faststop
+        if not cfg.enabled or not self._drivers:
+            # Drivers not yet known, so play it safe.
+            return False
+        safe = { 'VO': cfg.vo.replace(' ', '').split(','),
+                 'AO': cfg.ao.replace(' ', '').split(',') }
+        for kind, driver in self._drivers.items():
+            if driver not in safe[kind]:
+                return False
+        return True
+
+
+    def _reap_child(self):
+        """
+        Sends SIGTERM to the child and detaches it from us.  The child is
+        reaped asynchronously, so a new child can be started immediately.
+        """
+        child, self._child = self._child, None
+        child.signals['finished'].disconnect(self._handle_child_exit)
+        child.signals['readline'].disconnect(self._handle_child_line)
+        _reaping.add(child)
+        child.signals['finished'].connect(lambda code: _reaping.discard(child))
+
+        def kill(sig):
+            # pid is None once the child exited, which may be before
+            # 'finished' is emitted.
+            pid = child.pid
+            if child in _reaping and pid:
+                log.debug('Sending signal %d to MPlayer pid %d', sig, pid)
+                try:
+                    os.kill(pid, sig)
+                except OSError:
+                    pass
+        kill(signal.SIGTERM)
+        # MPlayer handles SIGTERM and exits promptly, but if it's hung we
+        # make sure it's gone eventually.
+        kaa.OneShotTimer(kill, signal.SIGKILL).start(self._proxy._config.mplayer.watchdog.escalate * 8)
 
 
     @kaa.coroutine()
@@ -414,6 +764,17 @@ class MPlayer(object):
         self._reset_stream()
         self.state = STATE_OPENING
 
+        store = self._proxy._config.mplayer.identify.store
+        if store and media.scheme == 'file':
+            # The file may have been identified by a scan already.
+            info = get_store(os.path.expanduser(store)).get(media.url[7:])
+            if info:
+                log.debug('Stream info for %s from %s', media.url, store)
+                self._stream_info.update(info)
+                self.state = STATE_OPEN
+                self._proxy.signals['open'].emit()
+                yield None
+
         # The 'open' function is used to open the stream and provide
         # information about it. After that, the caller can still change stuff
         # before calling play. MPlayer doesn't work that way so we have to run
@@ -422,8 +783,19 @@ class MPlayer(object):
 
         self._child = kaa.Process(self._mp_cmd)
         self._child.delimiter = ['\r', '\n']
+        self._record(args, 'open')
         self._child.signals['readline'].connect_weak(self._handle_child_line)
-        yield self._child.start([ str(x) for x in args ])
+        # The InProgress returned by start() may finish before all output was
+        # read, 'finished' is only emitted after the last line.
+        ip = kaa.inprogress(self._child.signals['finished'])
+        self._child.start([ str(x) for x in args ])
+        apply_process_policy(self._child, self._proxy._config.process)
+        self._watchdog_start()
+        yield ip
+        self._watchdog.stop()
+        if self._watchdog_stage:
+            # Watchdog killed the identify child.
+            yield self._handle_fatal_error(self._error_message)
         # If we're here, identify was successful, so we're open for business.
         self.state = STATE_OPEN
         self._proxy.signals['open'].emit()
@@ -437,15 +809,32 @@ class MPlayer(object):
         args = self._media._mplayer_args[:]
         args.extend('-slave -v -osdlevel 0 -noautosub -nosub')
 
+        if config.httpcache.enabled and self._media.scheme == 'http':
+            # Read through the local caching proxy.
+            from ...httpcache import get_url
+            args[0] = get_url(args[0], config.httpcache)
+
         if self.audio_delay:
             args.add(delay=self.audio_delay)
-        if self.cache == 0:
+        cache = str(self.cache)
+        if cache in ('auto', '-1'):
+            info = self._stream_info
+            policy = cache_policy(self._media.scheme, info.get('vbitrate', 0) + info.get('abitrate', 0),
+                                  info.get('length', 0), config.mplayer.cache)
+            if policy:
+                args.add(cache=policy[0], cache_min='%.1f' % policy[1])
+                self._cache_min = policy[1]
+            else:
+                args.add(nocache=True)
+        elif cache == '0':
             args.add(nocache=True)
-        elif isinstance(self.cache, (long, float, int)) or self.cache.isdigit():
-            args.add(cache=self.cache)
+        elif cache.isdigit():
+            args.add(cache=cache)
         if self._ss_seek:
             args.add(ss=self._ss_seek)
             self._ss_seek = None
+        if self.speed != 1 and not self._trickplay(self.speed):
+            args.add(speed=self.speed)
 
         if self._media.get('corrupt'):
             # Index for the given file is corrupt.  Must add -idx to allow
@@ -454,10 +843,20 @@ class MPlayer(object):
             # the index for next time.
             args.append('-idx')
 
-        window = self._proxy.window
-        if window is None:
+        window = None
+        if self._media.media == kaa.metadata.MEDIA_AUDIO:
+            # Audio only, so skip the video output and all window handling.
+            # We don't even look at the proxy's window property, because that
+            # would create a window (and import kaa.display).
+            args.append('-novideo')
+        elif CAP_VO_SHM in self._proxy._caps and 'yuv4mpeg' in self._mp_info['video_drivers']:
+            # Frames go to shared memory (see frames property) instead of a
+            # window.
+            args.add(vo='yuv4mpeg:file=%s' % self._vo_shm_start())
+        elif self._proxy.window is None:
             args.add(vo='null')
         elif config.video.vdpau.enabled and 'vdpau' in self._mp_info['video_drivers']:
+            window = self._proxy.window
             if config.video.deinterlacing.enabled in ('auto', 'yes'):
                 deint = {'cheap': 1, 'good': 2, 'better': 3, 'best': 4}.get(config.video.deinterlacing.method, 3)
                 args.add(vo='vdpau:deint=%d,xv,x11' % deint)
@@ -474,22 +873,18 @@ class MPlayer(object):
             # TODO: we could decide to add this only if the above condition is
             args.append('-framedrop')
         else:
+            window = self._proxy.window
             args.add(vo='xv,x11')
             vf.append(getattr(config.mplayer.deinterlacer, config.video.deinterlacing.method))
 
-        if isinstance(window, X11Window):
-            # Create a new inner window.  We must do this each time we start
-            # MPlayer because MPlayer destroys the window (even the ones it
-            # doesn't manage [!!]) at exit.
-            inner = self._proxy._window_inner = X11Window(size=(1,1), parent=window)
-            inner.set_cursor_visible(False)
-            inner.signals['key_press_event'].connect_weak(window.signals['key_press_event'].emit)
-            inner.show()
-            # Set owner to False so we don't try to destroy the window.
-            inner.owner = False
-            args.add(wid=hex(inner.id).rstrip('L'))
+        if lazy_isinstance(window, 'kaa.display', 'X11Window'):
+            # We must acquire a new video window each time we start MPlayer
+            # because MPlayer destroys the window (even the ones it doesn't
+            # manage [!!]) at exit.
+            video = self._proxy._window_acquire()
+            args.add(wid=hex(video.id).rstrip('L'))
             window.resize(self.width, self.height)
-        if isinstance(window, CandyStage):
+        if lazy_isinstance(window, 'kaa.candy', 'Stage'):
             args.add(wid=hex(window.wid).rstrip('L'))
             # The window cannot be resized with a different aspect
             # ratio anymore. But a kaa.candy stage is not designed to
@@ -534,13 +929,16 @@ class MPlayer(object):
         self._child = kaa.Process(self._mp_cmd)
         self._child.delimiter = ['\r', '\n']
         self._child.stop_command = 'quit\nquit\n'
+        self._record(args, 'play')
         self._child.signals['readline'].connect_weak(self._handle_child_line)
         self._child.signals['finished'].connect_weak(self._handle_child_exit)
         self._child.start([ str(x) for x in args ])
+        apply_process_policy(self._child, config.process)
+        self._watchdog_start()
         yield self._wait_for_signals('play', task='Play')
         # Play has begun successfully.  _handle_child_line() will already
         # have set state to STATE_PLAYING.
-        if isinstance(window, X11Window):
+        if lazy_isinstance(window, 'kaa.display', 'X11Window'):
             # XXX: is it reasonable to automatically show the window now?
             # Maybe we should have an autoshow property?
             window.show()
@@ -557,11 +955,22 @@ class MPlayer(object):
         log.info('Stopping mplayer (running: %s)', 'yes' if self._child else 'no')
         orig_state = self.state
         self.state = STATE_STOPPING
-        if self._child:
+        if self._child and self._can_fast_stop():
+            # No graceful quit needed, so don't wait for the child to exit.
+            self._reap_child()
+        elif self._child:
+            child = self._child
+            if orig_state != STATE_STOPPING:
+                # As with _reap_child(), the stream was stopped rather than
+                # finished, so its exit must not emit 'finished'.  (In
+                # STATE_STOPPING the child already reached the end of the
+                # stream, see _handle_child_line().)
+                child.signals['finished'].disconnect(self._handle_child_exit)
             # Tell child to quit; this will issue quit slave command twice in
             # case mplayer is paused.
-            yield self._child.stop()
-            # Once we get here, self._child is None.
+            yield child.stop()
+            self._child = None
+        self._watchdog.stop()
 
         # Child is dead, adjust state.
         self.state = STATE_NOT_RUNNING
@@ -570,22 +979,26 @@ class MPlayer(object):
             self._proxy.signals['stop'].emit()
 
 
-    @precondition(states=STATE_PLAYING)
+    # Here and below, the coroutine decorator must be the outermost one: kaa
+    # keeps a policy's state on the instance only if it finds the coroutine
+    # there.  Behind precondition, the state is shared by all players, and
+    # one player's seek() waits for another's.
     @kaa.coroutine(policy=kaa.POLICY_SINGLETON)
+    @precondition(states=STATE_PLAYING)
     def pause(self):
         self._slave_cmd('pause')
         yield self._wait_for_signals('pause', task='Pause')
 
 
-    @precondition(states=STATE_PAUSED)
     @kaa.coroutine(policy=kaa.POLICY_SINGLETON)
+    @precondition(states=STATE_PAUSED)
     def resume(self):
         self._slave_cmd('pause')
         yield self._wait_for_signals('play', task='Resume')
 
 
-    @precondition(states=(STATE_OPEN, STATE_PLAYING, STATE_PAUSED))
     @kaa.coroutine(policy=kaa.POLICY_PASS_LAST)
+    @precondition(states=(STATE_OPEN, STATE_PLAYING, STATE_PAUSED))
     def seek(self, value, type, last=None):
         if self._state == STATE_OPEN:
             # FIXME: it's possible to seek between launching MPlayer but before
@@ -610,6 +1023,59 @@ class MPlayer(object):
         yield self.position
 
 
+    @kaa.coroutine(policy=kaa.POLICY_SINGLETON)
+    @precondition(states=(STATE_PLAYING, STATE_PAUSED))
+    def frame_step(self, n=1):
+        """
+        Pauses and advances the stream by n frames.  The commands for all
+        frames are sent at once, and MPlayer's status line for each decoded
+        frame is counted, so there is no round-trip per frame.  Returns the
+        position after the last frame.
+        """
+        if n < 1:
+            raise ValueError('Number of frames to step must be positive, not %s' % n)
+        if self.state == STATE_PLAYING:
+            yield self.pause()
+        self._frame_steps = n
+        self._frame_step_done = kaa.InProgress()
+        # Sent without the pausing_keep prefix _slave_cmd() adds, which would
+        # keep MPlayer from decoding the frame.
+        log.info('Slave cmd: frame_step (%d times)', n)
+        self._child.write('frame_step\n' * n)
+        if self._recorder:
+            for i in range(n):
+                self._recorder.command('frame_step')
+        which, result = yield kaa.InProgressAny(self._frame_step_done, self._child)
+        if which == 1:
+            # Nothing will count the remaining frames.
+            self._frame_steps = 0
+            self._frame_step_done = None
+            raise PlayerError('MPlayer exited while stepping frames')
+        yield result
+
+
+    def loop(self, start, end=None):
+        """
+        Repeats the segment from start to end (in seconds) while playing;
+        end defaults to the length of the stream.  The position is checked
+        on every status line, so end is frame accurate, and passing it costs
+        a single seek command.  The start is only keyframe accurate: MPlayer
+        has no precise seeking, so it resumes at the keyframe at or before
+        start.  loop(None) ends looping.
+        """
+        if start is None:
+            self._loop = None
+            return
+        if end is None:
+            end = self.length
+            if not end:
+                raise ValueError('Loop end is required, the stream length is unknown')
+        if end <= start:
+            raise ValueError('Loop end %s is not after its start %s' % (end, start))
+        self._loop = float(start), float(end)
+        self._loop_seeking = False
+
+
     def reset(self):
         """
         Proxy is going to reuse us for a new file.  Reset all stream parameters.
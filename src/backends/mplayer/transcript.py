@@ -0,0 +1,130 @@
+# -*- coding: iso-8859-1 -*-
+# $Id$
+# -----------------------------------------------------------------------------
+# transcript.py - record and replay MPlayer child sessions
+# -----------------------------------------------------------------------------
+# kaa.popcorn - Generic Player API
+# Copyright (C) 2008 Jason Tackaberry, Dirk Meyer
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+# -----------------------------------------------------------------------------
+
+"""
+A transcript is the timestamped stream of lines an MPlayer child printed,
+together with the slave commands we sent it.  It is a text file, gzipped if
+the name ends with .gz, with one event per line::
+
+    <seconds since start>\t<O|I>\t<text>
+
+where O is a line of output from the child and I a command sent to it.
+Lines starting with # are comments; the recorder stores the child's
+arguments this way.  test/fakemplayer.py replays the same format.
+"""
+
+__all__ = [ 'Recorder', 'read', 'replay' ]
+
+# python imports
+import time
+import gzip
+import logging
+
+# kaa imports
+import kaa
+
+# get logging object
+log = logging.getLogger('popcorn.mplayer')
+
+
+class Recorder(object):
+    """
+    Records a transcript of an MPlayer child session.
+    """
+    def __init__(self, filename, args=()):
+        if filename.endswith('.gz'):
+            self._fd = gzip.open(filename, 'wb')
+        else:
+            self._fd = open(filename, 'w')
+        self._start = time.time()
+        self.filename = filename
+        if args:
+            self._fd.write('# args: %s\n' % ' '.join(str(x) for x in args))
+
+
+    def _write(self, kind, text):
+        if self._fd:
+            self._fd.write('%.3f\t%s\t%s\n' % (time.time() - self._start, kind, text))
+
+
+    def output(self, line):
+        """
+        Records a line the child printed.
+        """
+        self._write('O', line.rstrip('\n'))
+
+
+    def command(self, cmd):
+        """
+        Records a slave command sent to the child.
+        """
+        self._write('I', cmd.rstrip('\n'))
+
+
+    def close(self, *args):
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+
+
+def read(filename):
+    """
+    Generator yielding (seconds, kind, text) for each event in a transcript.
+    """
+    fd = gzip.open(filename, 'rb') if filename.endswith('.gz') else open(filename)
+    try:
+        for line in fd:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            ts, kind, text = line.split('\t', 2)
+            yield float(ts), kind, text
+    finally:
+        fd.close()
+
+
+@kaa.coroutine()
+def replay(filename, backend, speed=1.0):
+    """
+    Feeds the child output recorded in a transcript into a backend.
+
+    @param filename: transcript file
+    @param backend: MPlayer backend instance whose _handle_child_line() is fed
+    @param speed: replay speed factor, e.g. 1.0 for real time, 10.0 for ten
+        times faster.  With 0, lines are fed without any delay.
+    @returns: InProgress finished with the number of lines fed
+    """
+    start = time.time()
+    count = 0
+    for ts, kind, text in read(filename):
+        if kind != 'O':
+            continue
+        if speed:
+            delay = start + ts / speed - time.time()
+            if delay > 0.001:
+                yield kaa.delay(delay)
+        backend._handle_child_line(text)
+        count += 1
+    yield count
@@ -23,16 +23,26 @@
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 # -----------------------------------------------------------------------------
 
-__all__ = [ 'ArgumentList', 'get_mplayer_info' ]
+__all__ = [ 'ArgumentList', 'get_mplayer_info', 'cache_policy', 'escalate' ]
 
 # python imports
 import re
 import os
 import stat
+import signal
+import logging
 
 # kaa imports
 import kaa
 
+# get logging object
+log = logging.getLogger('popcorn.mplayer')
+
+# Schemes of media read from local disks, which need no cache.  Optical
+# media are not among them: they spin up and seek slowly.
+LOCAL_SCHEMES = ('file',)
+OPTICAL_SCHEMES = ('dvd', 'vcd', 'cdda', 'cd')
+
 # A cache holding values specific to an MPlayer executable (version,
 # filter list, video/audio driver list, input keylist).  This dict is
 # keyed on the full path of the MPlayer binary.
@@ -155,3 +165,54 @@ def get_mplayer_info(path):
            
     _cache[path] = info
     return info
+
+
+def cache_policy(scheme, bitrate, length, cfg):
+    """
+    Sizes MPlayer's cache for the auto (-1) cache setting.
+
+    @param scheme: scheme of the stream's URL, e.g. 'file' or 'http'
+    @param bitrate: bitrate of the stream in bits per second, 0 if unknown
+    @param length: length of the stream in seconds, 0 if unknown
+    @param cfg: the mplayer.cache config group
+    @returns: (size, min) for the -cache (kilobytes) and -cache-min
+        (percent) options, or None if the stream should not be cached.
+
+    The cache holds cfg.seconds of the stream, but never more than the
+    whole stream, and playback starts once cfg.prefill seconds of it are
+    buffered (a second for optical media, which are not starved by the
+    network).
+    """
+    if scheme in LOCAL_SCHEMES:
+        return None
+    bitrate = bitrate or cfg.bitrate * 1000
+    # Kilobytes per second.
+    rate = bitrate / 8192.0
+    size = rate * cfg.seconds
+    if length:
+        size = min(size, rate * length)
+    # MPlayer refuses caches below 32 KB.
+    size = int(max(min(size, cfg.maximum), 32))
+    prefill = 1 if scheme in OPTICAL_SCHEMES else cfg.prefill
+    return size, max(min(100.0 * rate * prefill / size, 99.0), 1.0)
+
+
+def escalate(child, stage):
+    """
+    Takes an escalation step to end a hung MPlayer child: stage 1 sends the
+    quit command, stage 2 SIGTERM and stage 3 SIGKILL.  The caller waits a
+    while between the steps.  Returns False after the last step.
+    """
+    try:
+        if stage == 1:
+            child.write('quit\n')
+        elif stage == 2:
+            log.warning('Watchdog: sending SIGTERM to MPlayer pid %d', child.pid)
+            os.kill(child.pid, signal.SIGTERM)
+        else:
+            log.warning('Watchdog: sending SIGKILL to MPlayer pid %d', child.pid)
+            os.kill(child.pid, signal.SIGKILL)
+            return False
+    except (IOError, OSError), e:
+        # Child is already gone.
+        log.debug('Watchdog: escalation step %d failed: %s', stage, e)
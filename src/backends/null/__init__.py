@@ -0,0 +1,58 @@
+# -*- coding: iso-8859-1 -*-
+# $Id$
+# -----------------------------------------------------------------------------
+# __init__.py - null backend
+# -----------------------------------------------------------------------------
+# kaa.popcorn - Generic Player API
+# Copyright (C) 2008 Jason Tackaberry, Dirk Meyer
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'import_backend' ]
+
+from ...common import *
+
+def get_capabilities():
+    """
+    Return capabilities of the null backend.
+    """
+    from config import config
+
+    if not config.enabled:
+        return None, None, None, None, None
+
+    capabilities = {
+        CAP_VIDEO: True,
+        CAP_DYNAMIC_FILTERS : False,
+        CAP_VARIABLE_SPEED : False,
+        CAP_VISUALIZATION : False,
+        CAP_DVD : False,
+        CAP_DVD_MENUS : False,
+        CAP_DEINTERLACE : True
+    }
+
+    schemes = [ 'file', 'http', 'ftp', 'dvd', 'fifo' ]
+    # Never preferred for any extension, codec or video driver.
+    return capabilities, schemes, [], [], []
+
+
+def import_backend():
+    """
+    Return player name, class and capability function.
+    """
+    return ('null', __name__ + '.player:NullPlayer', get_capabilities)
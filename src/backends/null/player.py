@@ -0,0 +1,328 @@
+# -*- coding: iso-8859-1 -*-
+# $Id$
+# -----------------------------------------------------------------------------
+# player.py - null backend
+# -----------------------------------------------------------------------------
+# kaa.popcorn - Generic Player API
+# Copyright (C) 2008 Jason Tackaberry, Dirk Meyer
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'NullPlayer' ]
+
+# python imports
+import logging
+import time
+import weakref
+
+# kaa imports
+import kaa
+from kaa.utils import property
+
+# kaa.popcorn imports
+from ...common import *
+
+# get logging object
+log = logging.getLogger('popcorn.null')
+
+# Players currently in STATE_PLAYING.  A single timer drives the simulated
+# clock of all of them, so thousands of players don't need thousands of
+# timers.
+_playing = weakref.WeakKeyDictionary()
+
+
+def _clock_tick():
+    if not _playing:
+        return False
+    now = time.time()
+    for player in _playing.keys():
+        player._tick(now)
+
+_clock = kaa.Timer(_clock_tick)
+
+
+class NullPlayer(object):
+    """
+    Backend that plays nothing.  Playback is simulated in-process with a clock
+    and configurable latencies, so the proxy can be driven without spawning
+    any children.
+    """
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._state = STATE_NOT_RUNNING
+        self._media = None
+        self._reset_stream()
+
+
+    #########################################
+    # Properties
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        if self._state != value:
+            log.debug('State change: %s -> %s', self._state, value)
+            if value == STATE_PLAYING:
+                if not _playing:
+                    # Clock stops by itself once nobody is playing.
+                    _clock.start(self._proxy._config.null.interval)
+                _playing[self] = True
+            else:
+                _playing.pop(self, None)
+            self._state = value
+
+
+    @property
+    def position(self):
+        if self._state == STATE_PLAYING:
+            elapsed = (time.time() - self._clock_started) * self._clock_timescale
+            return min(self._clock_position + elapsed, self.length)
+        return self._clock_position
+
+    @property
+    def width(self):
+        return self._stream_info.get('width')
+
+    @property
+    def height(self):
+        return self._stream_info.get('height')
+
+    @property
+    def aspect(self):
+        try:
+            return self._stream_info.get('aspect') or (self.width / float(self.height)) or 1.0
+        except (ZeroDivisionError, TypeError):
+            return 1.0
+
+    @property
+    def vfourcc(self):
+        return self._stream_info.get('vfourcc')
+
+    @property
+    def afourcc(self):
+        return self._stream_info.get('afourcc')
+
+    @property
+    def length(self):
+        return self._stream_info.get('length')
+
+    @property
+    def uri(self):
+        return self._stream_info.get('uri')
+
+    @property
+    def seekable(self):
+        return True
+
+    @property
+    def audio_delay(self):
+        return self._stream_info.get('audio_delay', 0.0)
+
+    @audio_delay.setter
+    def audio_delay(self, value):
+        self._stream_info['audio_delay'] = float(value)
+
+    @property
+    def cache(self):
+        return self._stream_info.get('cache', 'auto')
+
+    @cache.setter
+    def cache(self, value):
+        self._stream_info['cache'] = value
+
+    @property
+    def deinterlace(self):
+        return self._stream_info.get('deinterlace', False)
+
+    @deinterlace.setter
+    def deinterlace(self, value):
+        self._stream_info['deinterlace'] = bool(value)
+
+
+    #########################################
+    # Private Methods
+
+    def _reset_stream(self):
+        """
+        Resets stream parameters.
+        """
+        self._stream_info = {
+            'audio_delay': self._proxy._config.audio.delay,
+            'deinterlace': {'yes': True, 'no': False}.get(self._proxy._config.video.deinterlacing.enabled, 'auto'),
+            'cache': self._proxy._config.cache
+        }
+        # Stream position when the clock was (re)started, the wall time at
+        # which that happened, and null.timescale at that time.  Reading the
+        # config on each position lookup would cost more than the rest of it.
+        self._clock_position = 0.0
+        self._clock_started = 0.0
+        self._clock_timescale = 1.0
+        # Position reported in the last position-changed signal.
+        self._last_position = 0.0
+
+
+    def _set_position(self, position):
+        self._clock_position = position
+        self._clock_started = time.time()
+        self._clock_timescale = self._proxy._config.null.timescale
+
+
+    def _delay(self, name):
+        """
+        Returns an InProgress for the simulated latency of the given
+        operation, or None if there is no latency.
+        """
+        latency = getattr(self._proxy._config.null.latency, name)
+        if latency > 0:
+            return kaa.delay(latency)
+
+
+    def _tick(self, now):
+        """
+        Called by the clock while playing.
+        """
+        pos = self.position
+        old, self._last_position = self._last_position, pos
+        self._proxy.signals['position-changed'].emit(old, pos)
+        if pos >= self.length:
+            log.debug('End of stream %s', self.uri)
+            self.state = STATE_NOT_RUNNING
+            self._reset_stream()
+            self._proxy._emit_finished(None)
+
+
+    #########################################
+    # Public Methods
+
+    @precondition(states=STATE_NOT_RUNNING)
+    @kaa.coroutine()
+    def open(self, media):
+        """
+        Opens an MRL.  Stream properties are taken from the metadata.
+        """
+        self._media = media
+        self._reset_stream()
+        self.state = STATE_OPENING
+        ip = self._delay('open')
+        if ip:
+            yield ip
+
+        info = self._stream_info
+        info['uri'] = media.url
+        info['length'] = media.get('length') or self._proxy._config.null.length
+        video = media.get('video')
+        if video:
+            info.update(width=video[0].get('width'), height=video[0].get('height'),
+                        aspect=video[0].get('aspect'), vfourcc=video[0].get('fourcc'))
+        audio = media.get('audio')
+        if audio:
+            info['afourcc'] = audio[0].get('fourcc')
+        self.state = STATE_OPEN
+
+
+    @precondition(states=STATE_OPEN)
+    @kaa.coroutine()
+    def play(self):
+        self.state = STATE_STARTING
+        ip = self._delay('start')
+        if ip:
+            yield ip
+        if self._state != STATE_STARTING:
+            # Stopped while starting.
+            yield None
+        if self._stream_info['deinterlace'] == 'auto':
+            self._stream_info['deinterlace'] = bool(getattr(self._media, 'interlaced', False))
+        self._set_position(self._clock_position)
+        self.state = STATE_PLAYING
+        self._proxy.signals['stream-changed'].emit()
+        self._proxy.signals['start'].emit()
+        self._proxy.signals['play'].emit()
+
+
+    @kaa.coroutine(policy=kaa.POLICY_SINGLETON)
+    def stop(self):
+        if self._state == STATE_NOT_RUNNING:
+            yield True
+        orig_state = self._state
+        self.state = STATE_STOPPING
+        ip = self._delay('stop')
+        if ip:
+            yield ip
+        self.state = STATE_NOT_RUNNING
+        self._reset_stream()
+        if orig_state in (STATE_STARTING, STATE_PLAYING, STATE_PAUSED):
+            self._proxy.signals['stop'].emit()
+
+
+    @precondition(states=STATE_PLAYING)
+    @kaa.coroutine()
+    def pause(self):
+        self._set_position(self.position)
+        self.state = STATE_PAUSED
+        self._proxy.signals['pause'].emit()
+        yield None
+
+
+    @precondition(states=STATE_PAUSED)
+    @kaa.coroutine()
+    def resume(self):
+        self._set_position(self._clock_position)
+        self.state = STATE_PLAYING
+        self._proxy.signals['play'].emit()
+        yield None
+
+
+    @precondition(states=(STATE_OPEN, STATE_PLAYING, STATE_PAUSED))
+    @kaa.coroutine()
+    def seek(self, value, type):
+        old = self.position
+        if type == SEEK_RELATIVE:
+            value += old
+        elif type == SEEK_PERCENTAGE:
+            value = self.length * value / 100
+        value = min(max(value, 0), self.length)
+        if self._state == STATE_OPEN:
+            # Start position for play().
+            self._clock_position = value
+            yield None
+
+        ip = self._delay('seek')
+        if ip:
+            yield ip
+        self._set_position(value)
+        self._proxy.signals['seek'].emit(old, value)
+        yield value
+
+
+    def reset(self):
+        """
+        Proxy is going to reuse us for a new file.  Stream is already reset
+        by stop(), so this is a no-op.
+        """
+        pass
+
+
+    def release(self):
+        """
+        Proxy is going to use a different backend.  We hold no resources.
+        """
+        return kaa.NotFinished
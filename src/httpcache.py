@@ -0,0 +1,362 @@
+# -*- coding: iso-8859-1 -*-
+# $Id$
+# -----------------------------------------------------------------------------
+# httpcache.py - Local read-ahead caching proxy for http streams
+# -----------------------------------------------------------------------------
+# kaa.popcorn - Generic Player API
+# Copyright (C) 2008 Jason Tackaberry, Dirk Meyer
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+# -----------------------------------------------------------------------------
+
+"""
+A local HTTP proxy the backends can point their children at instead of a
+remote http:// URL.  Remote resources are fetched in fixed size segments
+with range requests and kept in a disk cache, so reopening a stream or
+seeking back doesn't hit the network again.  While a client reads, the
+segments ahead of it are fetched in the background.
+
+Resources whose server doesn't honour range requests, or whose length is
+unknown (e.g. live streams), are passed through uncached.
+
+The proxy serves the remote URL http://host/path as
+http://127.0.0.1:<port>/http://host/path, see HTTPCache.url().
+"""
+
+__all__ = [ 'HTTPCache', 'get_url' ]
+
+# python imports
+import os
+import re
+import shutil
+import urllib
+import urllib2
+import hashlib
+import logging
+import threading
+import BaseHTTPServer
+import SocketServer
+
+# get logging object
+log = logging.getLogger('popcorn.httpcache')
+
+RE_RANGE = re.compile(r'bytes=(\d*)-(\d*)')
+RE_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+# HTTPCache started by get_url().
+_cache = None
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        log.debug('%s: %s', self.address_string(), format % args)
+
+
+    def do_GET(self):
+        cache = self.server.cache
+        url = urllib.unquote(self.path[1:])
+        if not url.startswith('http://'):
+            return self.send_error(404, 'Not a proxied URL')
+        try:
+            resource = cache.resource(url)
+        except (IOError, urllib2.URLError), e:
+            log.warning('Unable to fetch %s: %s', url, e)
+            return self.send_error(502, str(e))
+        if not resource:
+            return cache.passthrough(url, self)
+
+        length = resource['length']
+        start, end = 0, length - 1
+        m = RE_RANGE.match(self.headers.get('Range', ''))
+        if m and (m.group(1) or m.group(2)):
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), length - 1) if m.group(2) else length - 1
+            else:
+                # Suffix range: the last N bytes.
+                start = max(length - int(m.group(2)), 0)
+            if start >= length or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % length)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, length))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', resource['type'])
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        size = cache.segment
+        pos = start
+        try:
+            while pos <= end:
+                n = pos / size
+                data = cache.get_segment(url, resource, n)
+                cache.read_ahead(url, resource, n + 1)
+                self.wfile.write(data[pos - n * size:end - n * size + 1])
+                pos = (n + 1) * size
+        except (IOError, urllib2.URLError), e:
+            # Client went away (e.g. MPlayer seeked) or upstream failed.
+            log.debug('Request for %s ended: %s', url, e)
+
+
+
+class HTTPCache(object):
+    """
+    Caching HTTP proxy running in its own threads.
+
+    @param cachedir: directory for the segment cache
+    @param cachesize: maximum size of the cache in bytes; the least recently
+        used segments are removed beyond that
+    @param segment: segment size in bytes
+    @param readahead: number of segments to fetch ahead of a reader
+    """
+    def __init__(self, cachedir, cachesize, segment=1024*1024, readahead=4):
+        self.cachedir = cachedir
+        self.cachesize = cachesize
+        self.segment = segment
+        self.readahead = readahead
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        # Length and content type of remote resources (None if they can't be
+        # cached), keyed by URL.
+        self._resources = {}
+        # Events for segments being fetched, keyed by file name.
+        self._fetching = {}
+        self._lock = threading.Lock()
+        # Bytes in the cache, computed on the first eviction.
+        self._size = None
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.cache = self
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever, name='popcorn-httpcache')
+        thread.daemon = True
+        thread.start()
+        log.info('HTTP cache listening on port %d, caching in %s', self.port, cachedir)
+
+
+    def url(self, url):
+        """
+        Returns the URL under which the proxy serves the given remote URL.
+        """
+        return 'http://127.0.0.1:%d/%s' % (self.port, urllib.quote(url, safe=':/'))
+
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def _path(self, url, n=None):
+        path = os.path.join(self.cachedir, hashlib.sha1(url).hexdigest())
+        return path if n is None else os.path.join(path, '%08d' % n)
+
+
+    def _fetch(self, url, start, end):
+        request = urllib2.Request(url, headers={'Range': 'bytes=%d-%d' % (start, end)})
+        return urllib2.urlopen(request, timeout=30)
+
+
+    def resource(self, url):
+        """
+        Returns a dict with length and content type of the remote resource,
+        or None if it can't be cached.  The first segment is fetched along
+        the way.
+        """
+        if url in self._resources:
+            return self._resources[url]
+        resource = None
+        path = self._path(url)
+        try:
+            fd = open(os.path.join(path, 'info'))
+            length, type = fd.read().split('\n', 1)
+            fd.close()
+            resource = { 'length': int(length), 'type': type }
+        except (IOError, ValueError):
+            response = self._fetch(url, 0, self.segment - 1)
+            m = RE_CONTENT_RANGE.match(response.info().get('Content-Range', ''))
+            if response.getcode() == 206 and m and m.group(3) != '*':
+                resource = { 'length': int(m.group(3)),
+                             'type': response.info().get('Content-Type', 'application/octet-stream') }
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                self._store(self._path(url, 0), response.read())
+                fd = open(os.path.join(path, 'info'), 'w')
+                fd.write('%d\n%s' % (resource['length'], resource['type']))
+                fd.close()
+            else:
+                log.info('Not caching %s: no range support or unknown length', url)
+            response.close()
+        self._resources[url] = resource
+        return resource
+
+
+    def _store(self, fname, data):
+        tmp = '%s.%d' % (fname, threading.current_thread().ident)
+        fd = open(tmp, 'wb')
+        fd.write(data)
+        fd.close()
+        os.rename(tmp, fname)
+        self._evict(len(data))
+
+
+    def get_segment(self, url, resource, n):
+        """
+        Returns the data of segment n, from the cache or fetched.
+        """
+        fname = self._path(url, n)
+        while True:
+            try:
+                fd = open(fname, 'rb')
+            except IOError:
+                pass
+            else:
+                data = fd.read()
+                fd.close()
+                try:
+                    # Mark as recently used for _evict().
+                    os.utime(fname, None)
+                except OSError:
+                    pass
+                return data
+            self._lock.acquire()
+            event = self._fetching.get(fname)
+            if not event:
+                event = self._fetching[fname] = threading.Event()
+                self._lock.release()
+                break
+            self._lock.release()
+            # Fetched by another thread, wait for it and read it.
+            event.wait(60)
+        try:
+            start = n * self.segment
+            response = self._fetch(url, start, min(start + self.segment, resource['length']) - 1)
+            data = response.read()
+            response.close()
+            self._store(fname, data)
+            return data
+        finally:
+            self._lock.acquire()
+            del self._fetching[fname]
+            self._lock.release()
+            event.set()
+
+
+    def read_ahead(self, url, resource, n):
+        """
+        Fetches the segments starting at n in the background.
+        """
+        last = min(n + self.readahead, (resource['length'] - 1) / self.segment + 1)
+        todo = [ i for i in range(n, last) if not os.path.exists(self._path(url, i))
+                 and self._path(url, i) not in self._fetching ]
+        if not todo:
+            return
+        def fetch():
+            for i in todo:
+                try:
+                    self.get_segment(url, resource, i)
+                except (IOError, urllib2.URLError), e:
+                    log.debug('Read-ahead of %s failed: %s', url, e)
+                    return
+        thread = threading.Thread(target=fetch, name='popcorn-httpcache-readahead')
+        thread.daemon = True
+        thread.start()
+
+
+    def passthrough(self, url, handler):
+        """
+        Forwards the request to the server, uncached.
+        """
+        headers = {}
+        if 'Range' in handler.headers:
+            headers['Range'] = handler.headers['Range']
+        try:
+            response = urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=30)
+        except urllib2.HTTPError, e:
+            return handler.send_error(e.code, str(e))
+        except (IOError, urllib2.URLError), e:
+            return handler.send_error(502, str(e))
+        handler.send_response(response.getcode())
+        for header in ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges'):
+            if response.info().get(header):
+                handler.send_header(header, response.info()[header])
+        handler.end_headers()
+        try:
+            shutil.copyfileobj(response, handler.wfile, self.segment)
+        except IOError:
+            pass
+        response.close()
+
+
+    def _evict(self, added):
+        """
+        Removes the least recently used segments once the cache is larger
+        than allowed.
+        """
+        self._lock.acquire()
+        try:
+            if self._size is None:
+                self._size = sum(os.path.getsize(os.path.join(d, f))
+                                 for d, dirs, files in os.walk(self.cachedir) for f in files)
+            else:
+                self._size += added
+            if self._size <= self.cachesize:
+                return
+            segments = []
+            for d, dirs, files in os.walk(self.cachedir):
+                for f in files:
+                    if f != 'info' and '.' not in f:
+                        st = os.stat(os.path.join(d, f))
+                        segments.append((st.st_mtime, st.st_size, os.path.join(d, f)))
+            segments.sort()
+            # Go below the limit by a bit, so we don't walk the cache on
+            # every segment stored.
+            while segments and self._size > self.cachesize * 0.9:
+                mtime, size, fname = segments.pop(0)
+                try:
+                    os.unlink(fname)
+                    self._size -= size
+                except OSError:
+                    pass
+        finally:
+            self._lock.release()
+
+
+def get_url(url, cfg):
+    """
+    Returns the URL of the given remote URL in the caching proxy, which is
+    started on first use, or the URL itself if it can't be proxied.
+
+    @param cfg: the httpcache config group
+    """
+    global _cache
+    if not url.startswith('http://'):
+        return url
+    if _cache is None:
+        _cache = HTTPCache(os.path.expanduser(cfg.cachedir), cfg.cachesize * 1024 * 1024,
+                           cfg.segment * 1024, cfg.readahead)
+    return _cache.url(url)
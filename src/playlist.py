@@ -0,0 +1,258 @@
+# -*- coding: iso-8859-1 -*-
+# $Id$
+# -----------------------------------------------------------------------------
+# playlist.py - Playlist with metadata prefetch and gapless advance
+# -----------------------------------------------------------------------------
+# kaa.popcorn - Generic Player API
+# Copyright (C) 2008 Jason Tackaberry, Dirk Meyer
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'Playlist' ]
+
+# python imports
+import logging
+
+# kaa imports
+import kaa
+
+# kaa.popcorn imports
+from backends import manager
+from config import config
+from utils import parse_media
+
+# get logging object
+log = logging.getLogger('popcorn.playlist')
+
+
+# One thread, so entries are parsed in the order they were requested.
+kaa.register_thread_pool('popcorn::playlist', kaa.ThreadPool(size=1))
+
+@kaa.threaded('popcorn::playlist')
+def _parse(mrl):
+    return parse_media(mrl)
+
+
+class Playlist(kaa.Object):
+    """
+    A list of streams played one after another by a Player.
+
+    :param player: the :class:`~kaa.popcorn.Player` playing the entries
+    :param items: file names or URLs of the entries
+    :param depth: number of entries after the current one that are parsed
+        ahead of time; defaults to the playlist.depth config value
+    :param memory: kilobytes of the next entry read into the page cache
+        before the current one ends; defaults to the playlist.memory config
+        value
+
+    While an entry plays, the next entries are parsed with kaa.metadata in a
+    thread and the backend for them is chosen, and shortly before the end
+    the beginning of the next entry is read into the page cache.  When an
+    entry finishes, the next one is opened right away from the parsed
+    metadata with the chosen backend, which keeps the gap between entries
+    short.  The backend is not started ahead of time though: the next
+    entry still has to be opened (identified) by it, so playback is not
+    truly gapless.
+
+    Only the parsed metadata of the current entry and the entries within
+    depth after it is kept.
+    """
+    __kaasignals__ = {
+        'changed':
+            '''
+            Emitted when another entry is opened.
+
+            .. describe:: def callback(index, ...)
+
+               :param index: index of the entry in the playlist
+               :type index: int
+            ''',
+
+        'finished':
+            '''
+            Emitted when the last entry finished playing.
+
+            .. describe:: def callback(...)
+            '''
+    }
+
+    def __init__(self, player, items=(), depth=None, memory=None):
+        super(Playlist, self).__init__()
+        self.depth = config.playlist.depth if depth is None else depth
+        self.memory = config.playlist.memory if memory is None else memory
+        self._player = player
+        self._items = list(items)
+        self._index = -1
+        # Parsed Media objects (or InProgress objects while being parsed),
+        # and the ids of the backends chosen for them, keyed by mrl.
+        self._media = {}
+        self._backends = {}
+        # Index of the entry read into the page cache, see _handle_position().
+        self._preloaded = None
+        # Number of entry switches and stops in progress, during which the
+        # player's 'finished' signal is not the end of an entry.
+        self._switching = 0
+        player.signals['finished'].connect_weak(self._handle_finished)
+        player.signals['position-changed'].connect_weak(self._handle_position)
+
+
+    @property
+    def items(self):
+        """
+        File names or URLs of the entries.
+        """
+        return self._items[:]
+
+
+    @property
+    def index(self):
+        """
+        Index of the current entry, -1 before the first is opened.
+        """
+        return self._index
+
+
+    def append(self, mrl):
+        self._items.append(mrl)
+        self._prefetch()
+
+
+    def extend(self, mrls):
+        self._items.extend(mrls)
+        self._prefetch()
+
+
+    def clear(self):
+        self._items = []
+        self._index = -1
+        self._media = {}
+        self._backends = {}
+
+
+    def _resolve(self, mrl):
+        """
+        Returns the Media object for mrl, or an InProgress finished with it
+        while it is parsed in a thread.
+        """
+        if mrl not in self._media:
+            self._media[mrl] = _parse(mrl)
+            self._media[mrl].connect(self._handle_parsed, mrl)
+        return self._media[mrl]
+
+
+    def _handle_parsed(self, media, mrl):
+        if not isinstance(self._media.get(mrl), kaa.InProgress):
+            # Forgotten by _prefetch() in the meantime.
+            return
+        self._media[mrl] = media
+        # Loads the backends and the capabilities they detect (which may mean
+        # running them) now rather than when the entry is opened, and
+        # remembers the choice for play().
+        cls = manager.get_player_class(media, None, [], None, self._player._config)
+        if cls:
+            self._backends[mrl] = cls._player_id
+
+
+    def _prefetch(self):
+        """
+        Starts parsing the entries within depth after the current one and
+        forgets the parsed metadata of all others.
+        """
+        ahead = self._items[max(self._index, 0):self._index + self.depth + 1]
+        for mrl in self._media.keys():
+            if mrl not in ahead:
+                del self._media[mrl]
+                self._backends.pop(mrl, None)
+        for mrl in ahead:
+            self._resolve(mrl)
+
+
+    @kaa.coroutine()
+    def play(self, index=None):
+        """
+        Opens and plays an entry.
+
+        :param index: index of the entry; defaults to the current entry, or
+            the first if none was opened yet
+        """
+        if index is None:
+            index = max(self._index, 0)
+        if not 0 <= index < len(self._items):
+            raise IndexError('Playlist has no entry %d' % index)
+        self._index = index
+        self._preloaded = None
+        mrl = self._items[index]
+        media = self._resolve(mrl)
+        if isinstance(media, kaa.InProgress):
+            media = yield media
+        self._prefetch()
+        self._switching += 1
+        try:
+            yield self._player.open(media, player=self._backends.get(mrl))
+        finally:
+            self._switching -= 1
+        self.signals['changed'].emit(index)
+        yield self._player.play()
+
+
+    def next(self):
+        """
+        Plays the entry after the current one.
+        """
+        return self.play(self._index + 1)
+
+
+    def previous(self):
+        """
+        Plays the entry before the current one.
+        """
+        return self.play(self._index - 1)
+
+
+    @kaa.coroutine()
+    def stop(self):
+        """
+        Stops the current entry without advancing to the next.
+        """
+        self._switching += 1
+        try:
+            yield self._player.stop()
+        finally:
+            self._switching -= 1
+
+
+    def _handle_position(self, oldpos, newpos):
+        following = self._index + 1
+        if self._preloaded == following or following >= len(self._items):
+            return
+        length = getattr(self._player.stream, 'length', None)
+        if length and length - newpos < config.playlist.preload:
+            self._preloaded = following
+            self._player.prefetch(self._items[following], self.memory * 1024)
+
+
+    def _handle_finished(self, exc):
+        if self._switching:
+            # The entry was left by play() or stop(), it didn't end.
+            return
+        if exc is not None:
+            log.warning('Entry %d of the playlist failed: %s', self._index, exc)
+        if self._index + 1 < len(self._items):
+            self.next()
+        else:
+            self.signals['finished'].emit()
@@ -26,52 +26,91 @@
 __all__ = ['Player']
 
 # python imports
+import os
 import logging
 
 # kaa imports
 import kaa
-import kaa.metadata
 from kaa.weakref import weakref
 from kaa.utils import property
-import kaa.display
 
 # kaa.popcorn imports
 from backends import manager
 from common import *
 from config import config
+from utils import lazy_isinstance, parse_media, prefetch as prefetch_file
+from resume import get_store as get_resume_store
 
 # get logging object
 log = logging.getLogger('popcorn')
 
 
 class StreamProperties(object):
+    """
+    Exposes the properties of the current backend, except 'state', which
+    backends do have, but we don't expose it to the caller because it is
+    settable.
+
+    Resolving the property on every access is too slow for properties like
+    position that UIs poll many times per second, so for each backend class
+    a subclass is generated (see specialize()) with one property per
+    backend property, calling the backend's getter and setter directly.
+    The player switches its StreamProperties instance to the subclass for
+    the backend in use, so references to it held by the caller stay valid.
+    """
+    # Backend class this class was generated for, and the names of the
+    # properties it exposes.
+    _backend_class = None
+    _props = frozenset()
+    # Generated subclasses, keyed by backend class.
+    _specialized = {}
+
     def __init__(self, player):
         self._player = weakref(player)
 
 
-    def _check_prop(self, prop):
+    @classmethod
+    def specialize(cls, backend_class):
         """
-        Ensures the backend has the given property.  A special case is made for
-        the 'state' property, which backends do have, but we don't expose it
-        to the caller because it is settable.
+        Returns the StreamProperties subclass for the given backend class.
         """
-        if prop == 'state' or \
-           getattr(self._player._backend.__class__, prop, None).__class__.__name__ != 'property':
-            raise AttributeError('Stream does not have property: %s' % prop)
+        try:
+            return cls._specialized[backend_class]
+        except KeyError:
+            pass
+        attrs = {}
+        for name in dir(backend_class):
+            prop = getattr(backend_class, name, None)
+            if name.startswith('_') or name == 'state' or prop.__class__.__name__ != 'property':
+                continue
+            attrs[name] = cls._make_property(prop)
+        attrs['_backend_class'] = backend_class
+        attrs['_props'] = frozenset(attrs)
+        subclass = type('%sStreamProperties' % backend_class.__name__, (cls,), attrs)
+        cls._specialized[backend_class] = subclass
+        return subclass
+
+
+    @staticmethod
+    def _make_property(prop):
+        fget, fset = prop.fget, prop.fset
+        getter = lambda self: fget(self._player._backend)
+        if not fset:
+            return property(getter)
+        return property(getter, lambda self, value: fset(self._player._backend, value))
 
 
     def __getattr__(self, attr):
+        # Only called for attributes that are not properties of the backend.
         if attr.startswith('_'):
-            return super(StreamProperties, self).__getattr__(attr)
-        self._check_prop(attr)
-        return getattr(self._player._backend, attr)
+            raise AttributeError(attr)
+        raise AttributeError('Stream does not have property: %s' % attr)
 
 
     def __setattr__(self, attr, value):
-        if attr.startswith('_'):
-            return super(StreamProperties, self).__setattr__(attr, value)
-        self._check_prop(attr)
-        return setattr(self._player._backend, attr, value)
+        if not attr.startswith('_') and attr not in self._props:
+            raise AttributeError('Stream does not have property: %s' % attr)
+        return super(StreamProperties, self).__setattr__(attr, value)
 
 
 
@@ -232,6 +271,22 @@ class Player(kaa.Object):
             STATE_PAUSED.
             ''',
 
+        'buffering':
+            '''
+            Emitted while the backend fills its cache, before the stream
+            starts playing or after the cache ran empty during playback.
+
+            .. describe:: def callback(progress, ...)
+
+               :param progress: percentage of the data needed to (re)start
+                                playback that is buffered
+               :type progress: float
+
+            The last emission while buffering has a progress of 100.  Only
+            emitted for streams that are cached, see the cache stream
+            property.
+            ''',
+
         'stream-changed':
             '''
             Emitted when one or more attributes of the stream have changed
@@ -262,10 +317,25 @@ class Player(kaa.Object):
         super(Player, self).__init__()
         # Backend instance currently in use.  This is assigned in open()
         self._backend = None
+        # Capabilities requested for the current stream.
+        self._caps = ()
+        # Names of the backend methods cached in our __dict__ by __getattr__.
+        self._backend_proxied = []
         # kaa.display.X11Window object; False means video disabled.
         self._window = None
-        # The inner window that is created and managed by the backend.
+        # The inner window, a child of the outer window which is kept for
+        # the lifetime of the outer window, and the disposable child of it
+        # handed to the backend for the video.  See _window_acquire().
         self._window_inner = None
+        self._window_video = None
+        # Geometry of the last layout (outer and inner window, outer size,
+        # aspect) and the resulting letterbox bars as (pos, size) tuples.
+        # See _window_layout().
+        self._window_geometry = None
+        self._window_bars = []
+        # Regions exposed while a layout is pending, see _window_handle_expose().
+        self._window_exposed = []
+        self._window_resize_timer = kaa.WeakOneShotTimer(self._window_relayout)
         # kaa.metadata Media object for the currently opened mrl.
         self._media = None
         self._stream = StreamProperties(self)
@@ -274,6 +344,14 @@ class Player(kaa.Object):
         self._open_inprogress = None
         self._finished_inprogress = kaa.InProgress()
 
+        # ResumeStore and key in it of the current stream if its position is
+        # remembered (see the resume config group), otherwise None.
+        self._resume_store = None
+        self._resume_key = None
+        self.signals['position-changed'].connect_weak(self._resume_update)
+        self.signals['stop'].connect_weak(self._resume_stop)
+        self.signals['finished'].connect_weak(self._resume_finished)
+
         # Either the globally default config, or a copy-on-write clone of the global
         # config if the user accessed the config property.
         self._config = config
@@ -302,7 +380,9 @@ class Player(kaa.Object):
             return None
         if not self._window:
             # Create a new window on demand.  We invoke the window setter
-            # method to do some standard setup on the window.
+            # method to do some standard setup on the window.  kaa.display is
+            # imported only here, so that audio-only use never loads it.
+            import kaa.display
             self.window = kaa.display.X11Window(size=(1,1), title='Popcorn Player')
         return self._window
 
@@ -310,28 +390,27 @@ class Player(kaa.Object):
     def window(self, window):
         if window is None:
             # User wants to disable video output.
-            if self._window and isinstance(self._window, kaa.display.X11Window):
+            if self._window and lazy_isinstance(self._window, 'kaa.display', 'X11Window'):
                 # Clean up the existing window.
                 self._window.signals['expose_event'].disconnect(self._window_handle_expose)
                 self._window.signals['resize_event'].disconnect(self._window_handle_resize)
                 self._window.signals['delete_event'].disconnect(self._window_handle_delete)
                 self._window.signals['key_press_event'].disconnect(self._window_handle_key)
             self._window = False
-        elif window != self._window and isinstance(window, kaa.display.X11Window):
+        elif window != self._window and lazy_isinstance(window, 'kaa.display', 'X11Window'):
             self._window = window
             window.signals['expose_event'].connect_weak(self._window_handle_expose)
             window.signals['resize_event'].connect_weak(self._window_handle_resize)
             window.signals['delete_event'].connect_weak(self._window_handle_delete)
             window.signals['key_press_event'].connect_weak(self._window_handle_key)
-            # The inner child window is where the video actually displays, and
-            # it must be created and managed by the backend.  'window' is the
-            # outer window which will contain any black bars we draw to
-            # maintain aspect.
-            # TODO: we could be clever and instead of destroying any existing
-            # inner window, reparent it.
+            # The inner child window is where the video actually displays.
+            # 'window' is the outer window which will contain any black bars
+            # we draw to maintain aspect.  The inner window of the previous
+            # outer window is dropped; a new one is created the next time
+            # the backend acquires a video window.
             # FIXME: if we destroy the inner window while the backend is running,
             # ugly things will happen.
-            self._window_inner = None
+            self._window_inner = self._window_video = None
         elif window != self._window:
             self._window = window
 
@@ -430,50 +509,145 @@ class Player(kaa.Object):
         # Proxy anything not in our namespace to the backend.  Allows for
         # backend-specific extensions.  If the backend does not have the
         # requested attr or it isn't callable, raises an exception.
-        backend = object.__getattribute__(self, '_backend')
-        if backend:
-            try:
-                return object.__getattribute__(self, attr)
-            except AttributeError:
-                val = backend.__getattribute__(attr)
-                if callable(val):
-                    return val
+        #
+        # We are only called if normal lookup failed, so the backend's bound
+        # method is stored in our __dict__ and later calls cost no more than
+        # a normal method call.  _backend_proxy_flush() drops them again when
+        # the backend changes.
+        backend = self.__dict__.get('_backend')
+        if backend and not attr.startswith('__'):
+            val = getattr(backend, attr)
+            if callable(val):
+                self.__dict__[attr] = val
+                self._backend_proxied.append(attr)
+                return val
         return object.__getattribute__(self, attr)
 
 
-    def _window_layout(self):
+    def _backend_proxy_flush(self):
+        """
+        Forgets the backend methods cached by __getattr__.
+        """
+        for attr in self._backend_proxied:
+            self.__dict__.pop(attr, None)
+        del self._backend_proxied[:]
+
+
+    def _window_acquire(self):
+        """
+        Returns a new window for the backend to display the video in.
+
+        Backends like MPlayer destroy the window they were given when they
+        exit, so they can't be handed the inner window itself.  Instead they
+        get a disposable child of it, filling it completely.  The inner window
+        is created once per outer window and then kept, so starting a stream
+        costs one window creation and the area under the video is never
+        unmapped.  The backend must call _window_release() once the child
+        is gone.
+        """
+        from kaa.display import X11Window
+        outer = self.window
+        if not lazy_isinstance(outer, 'kaa.display', 'X11Window'):
+            return None
+        if not self._window_inner:
+            inner = self._window_inner = X11Window(size=(1,1), parent=outer)
+            inner.set_cursor_visible(False)
+            inner.show()
+            self._window_geometry = None
+        video = self._window_video = X11Window(size=self._window_inner.get_size(), parent=self._window_inner)
+        video.set_cursor_visible(False)
+        video.signals['key_press_event'].connect_weak(outer.signals['key_press_event'].emit)
+        video.show()
+        # Set owner to False so we don't try to destroy the window; this is
+        # done by the backend.
+        video.owner = False
+        return video
+
+
+    def _window_release(self):
+        """
+        Called by the backend once the window returned by _window_acquire()
+        is no longer in use.
+        """
+        self._window_video = None
+
+
+    def _window_layout(self, regions=None):
         """
         Resizes and moves the inner window to fill the outer window while
         maintaining aspect ratio, and paints black bars to fill the rest.
+
+        The geometry of the last layout is remembered, so nothing is done if
+        it hasn't changed.  If regions (a list of (pos, size) tuples from an
+        expose event) is given, only the parts of the bars inside them are
+        repainted.
         """
         outer, inner, backend = self._window, self._window_inner, self._backend
         if not outer or not inner or not backend:
             return
 
-        o_width, o_height = self._window.get_size()
-        o_aspect = float(o_width) / o_height
-        if backend.aspect >= o_aspect:
-            # Need bars on top/bottom; so inner window fills outer width
-            # and inner height is based on aspect.
-            i_width, i_height = o_width, int(o_width / backend.aspect)
-        else:
-            # Need bars on left/right; so inner window fills outer height
-            # and inner width is based on aspect.
-            i_width, i_height = int(o_height * backend.aspect), o_height
-
-        # We require backend to never return a zero aspect, so i_width/i_height
-        # should never be 0 unless the stream width or height reports 0.  As
-        # a last resort, if either are zero, stretch to the outer window dimension.
-        i_width, i_height = i_width or o_width, i_height or o_height
-        inner.resize(i_width, i_height)
-        inner.move((o_width - i_width) / 2, (o_height - i_height) / 2)
-        outer.draw_rectangle((0, 0), (o_width, o_height), '#000000')
+        o_width, o_height = outer.get_size()
+        geometry = outer, inner, (o_width, o_height), backend.aspect
+        if geometry != self._window_geometry:
+            self._window_geometry = geometry
+            o_aspect = float(o_width) / o_height
+            if backend.aspect >= o_aspect:
+                # Need bars on top/bottom; so inner window fills outer width
+                # and inner height is based on aspect.
+                i_width, i_height = o_width, int(o_width / backend.aspect)
+            else:
+                # Need bars on left/right; so inner window fills outer height
+                # and inner width is based on aspect.
+                i_width, i_height = int(o_height * backend.aspect), o_height
+
+            # We require backend to never return a zero aspect, so i_width/i_height
+            # should never be 0 unless the stream width or height reports 0.  As
+            # a last resort, if either are zero, stretch to the outer window dimension.
+            i_width, i_height = i_width or o_width, i_height or o_height
+            x, y = (o_width - i_width) / 2, (o_height - i_height) / 2
+            inner.resize(i_width, i_height)
+            inner.move(x, y)
+            if self._window_video:
+                self._window_video.resize(i_width, i_height)
+            if x:
+                bars = ((0, 0), (x, o_height)), ((x + i_width, 0), (o_width - x - i_width, o_height))
+            elif y:
+                bars = ((0, 0), (o_width, y)), ((0, y + i_height), (o_width, o_height - y - i_height))
+            else:
+                bars = ()
+            self._window_bars = [ bar for bar in bars if bar[1][0] > 0 and bar[1][1] > 0 ]
+            # New geometry, so all bars need painting.
+            regions = None
+        elif regions is None:
+            return
+
+        for (bx, by), (bw, bh) in self._window_bars:
+            if regions is None:
+                outer.draw_rectangle((bx, by), (bw, bh), '#000000')
+                continue
+            for (rx, ry), (rw, rh) in regions:
+                # Paint the intersection of the bar and the exposed region.
+                x0, y0 = max(bx, rx), max(by, ry)
+                x1, y1 = min(bx + bw, rx + rw), min(by + bh, ry + rh)
+                if x0 < x1 and y0 < y1:
+                    outer.draw_rectangle((x0, y0), (x1 - x0, y1 - y0), '#000000')
+
+    def _window_relayout(self):
+        regions, self._window_exposed = self._window_exposed, []
+        self._window_layout(regions or None)
 
     def _window_handle_expose(self, regions):
-        self._window_layout()
+        if self._window_resize_timer.active:
+            # Resizing: the pending layout paints these too.
+            self._window_exposed.extend(regions)
+        else:
+            self._window_layout(regions)
 
     def _window_handle_resize(self, oldsize, newsize):
-        self._window_layout()
+        # Window managers send a burst of these while the window is dragged,
+        # so do at most one layout per frame.
+        if not self._window_resize_timer.active:
+            self._window_resize_timer.start(1 / 60.0)
 
     def _window_handle_delete(self):
         self._window.hide()
@@ -493,25 +667,104 @@ class Player(kaa.Object):
         self._finished_inprogress = kaa.InProgress()
 
 
+    def _resume_update(self, oldpos, newpos):
+        if self._resume_key:
+            if newpos < self._config.resume.skip:
+                self._resume_store.forget(self._resume_key)
+            else:
+                self._resume_store.set(self._resume_key, newpos)
+
+    def _resume_stop(self):
+        if self._resume_key:
+            self._resume_store.flush()
+
+    def _resume_finished(self, exc):
+        if self._resume_key:
+            if exc is None:
+                # Played to the end, nothing to resume.
+                self._resume_store.forget(self._resume_key)
+            self._resume_store.flush()
+
+
+    @kaa.coroutine()
+    def prefetch(self, mrl, bytes=None):
+        """
+        Reads the beginning of a local file into the page cache, so a
+        subsequent open() and the start of playback don't wait for the disk.
+
+        :param mrl: file name or file:// URL; other URLs are ignored
+        :param bytes: number of bytes to read; defaults to the prefetch
+            config value, or playlist.memory if that is 0
+        :returns: :class:`~kaa.InProgress` finished with the number of bytes
+            read, 0 if the file can't be read
+
+        :class:`~kaa.popcorn.Playlist` calls this for the next entry while
+        the current one is still playing, which hides the latency
+        completely.  open() only does it if the prefetch config value is set,
+        as the file is read while being identified anyway.
+        """
+        path = mrl[7:] if mrl.startswith('file://') else mrl
+        if bytes is None:
+            bytes = (self._config.prefetch or self._config.playlist.memory) * 1024
+        if '://' in path or not bytes or not os.path.isfile(path):
+            yield 0
+        try:
+            yield prefetch_file(path, bytes)
+        except (IOError, OSError), e:
+            # Nothing waits for the prefetch; open() reports the real error.
+            log.debug('Unable to prefetch %s: %s', path, e)
+            yield 0
+
+
     @kaa.coroutine()
     def open(self, mrl, caps=None, player=None):
+        """
+        Opens a stream.
+
+        :param mrl: file name or URL of the stream, or a kaa.metadata Media
+            object of it (as returned by :func:`kaa.metadata.parse`), which
+            saves parsing the stream again
+        """
         if kaa.main.is_shutting_down():
             yield False
 
         if self._open_inprogress:
             yield self.stop()
 
-        media = kaa.metadata.parse(mrl)
-        if not media:
-            # unable to detect, create dummy media object.
-            if '://' not in mrl:
-                mrl = 'file://' + mrl
-            media = kaa.metadata.Media(hash=dict(url=mrl, media='MEDIA_UNKNOWN'))
-        media.scheme = media.url[:media.url.find(':/')]
+        media = None
+        if not isinstance(mrl, basestring):
+            media, mrl = mrl, mrl.url
+
+        if self._config.prefetch:
+            # Runs in the background while the file is parsed and opened.
+            self.prefetch(mrl)
+
+        store = key = None
+        if self._config.resume.enabled:
+            store = get_resume_store(self._config.resume)
+            key = store.key(mrl)
+
+        if media is None:
+            media = parse_media(mrl)
+        elif getattr(media, 'scheme', None) is None:
+            media.scheme = media.url[:media.url.find(':/')]
 
         try:
+            if self._resume_key:
+                # _open() stops the previous stream, which _resume_stop()
+                # won't see anymore, so write its last position now.
+                self._resume_store.flush()
+            self._resume_key = None
             self._open_inprogress = self._open(media, caps, player)
             yield self._open_inprogress
+            if key:
+                self._resume_store, self._resume_key = store, key
+                position = store.get(key)
+                if position:
+                    # In STATE_OPEN, the backend just remembers the position
+                    # to start playback at.
+                    log.info('Resuming %s at %.1f', media.url, position)
+                    self._backend.seek(position, SEEK_ABSOLUTE)
             self.signals['open'].emit(media)
         finally:
             self._open_inprogress = None
@@ -519,6 +772,8 @@ class Player(kaa.Object):
 
     @kaa.coroutine()
     def _open(self, media, caps, player):
+        if caps is not None and not isinstance(caps, (tuple, list)):
+            caps = (caps,)
         if self._window is not False and caps and CAP_VIDEO not in caps:
             caps = tuple(caps) + (CAP_VIDEO,)
 
@@ -535,6 +790,7 @@ class Player(kaa.Object):
                 # release all resources.
                 yield self._backend.release()
                 self._backend = None
+                self._backend_proxy_flush()
 
         if not cls:
             # No viable player found.
@@ -547,9 +803,13 @@ class Player(kaa.Object):
             self._backend.reset()
         else:
             # Create a new player of the given cls.
+            self._backend_proxy_flush()
             self._backend = cls(self)
 
+        if self._stream._backend_class is not self._backend.__class__:
+            self._stream.__class__ = StreamProperties.specialize(self._backend.__class__)
         self._media = media
+        self._caps = tuple(caps or ())
         yield self._backend.open(self.media)
 
 
@@ -597,6 +857,36 @@ class Player(kaa.Object):
         return self._backend.seek(value, type)
 
 
+    @precondition(backend=True)
+    def frame_step(self, n=1):
+        """
+        Pauses the stream and advances it by n frames.
+
+        :returns: :class:`~kaa.InProgress` finished with the position after
+            the last frame
+        """
+        if not hasattr(self._backend, 'frame_step'):
+            raise PlayerError('Current backend (%s) does not support frame stepping' % self._backend._player_id)
+        return self._backend.frame_step(n)
+
+
+    @precondition(backend=True)
+    def loop(self, start, end=None):
+        """
+        Repeats the segment of the stream from start to end (in seconds)
+        until loop(None) is called or another stream is opened.  The
+        boundary is checked by the backend on each frame, so looping needs
+        no seek round-trip through the player.  Backends may only be able
+        to jump back to the keyframe at or before start (MPlayer does).
+
+        :param start: start of the segment, or None to end looping
+        :param end: end of the segment; defaults to the end of the stream
+        """
+        if not hasattr(self._backend, 'loop'):
+            raise PlayerError('Current backend (%s) does not support looping' % self._backend._player_id)
+        return self._backend.loop(start, end)
+
+
     @precondition(backend=True)
     def nav(self, input):
         if CAP_DVD_MENUS not in self.capabilities:
@@ -0,0 +1,163 @@
+# -*- coding: iso-8859-1 -*-
+# $Id$
+# -----------------------------------------------------------------------------
+# resume.py - Store of resume positions of local files
+# -----------------------------------------------------------------------------
+# kaa.popcorn - Generic Player API
+# Copyright (C) 2008 Jason Tackaberry, Dirk Meyer
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+# -----------------------------------------------------------------------------
+
+"""
+If resume.enabled is set, the Player remembers the position in each local
+file it plays and opens the file at that position the next time.
+
+Files are identified by device, inode and size rather than by name, so
+renamed or moved files keep their position.  Positions are kept in memory
+while playing and written to a JSON file in batches: at most every
+resume.interval seconds, and when a stream is stopped or finished.
+"""
+
+__all__ = [ 'ResumeStore', 'get_store' ]
+
+# python imports
+import os
+import time
+import json
+import logging
+
+# kaa imports
+import kaa
+
+# get logging object
+log = logging.getLogger('popcorn.resume')
+
+# Open ResumeStore objects, keyed by file name.
+_stores = {}
+
+
+class ResumeStore(object):
+    """
+    Resume positions of local files, written behind to a JSON file.
+
+    @param filename: JSON file holding the positions
+    @param interval: seconds changed positions are kept in memory before
+        they are written
+    @param entries: maximum number of files remembered; the least recently
+        played are forgotten beyond that
+    """
+    def __init__(self, filename, interval=30, entries=1000):
+        self.filename = filename
+        self.entries = entries
+        # [position, time of last update], keyed by file identity.
+        self._positions = {}
+        self._dirty = False
+        self._flush_timer = kaa.WeakOneShotTimer(self.flush)
+        self._interval = interval
+        try:
+            fd = open(filename)
+            self._positions = json.load(fd)
+            fd.close()
+        except IOError:
+            pass
+        except ValueError, e:
+            log.warning('Ignoring corrupt resume store %s: %s', filename, e)
+
+
+    def key(self, mrl):
+        """
+        Returns the key of a file, or None if mrl is not a local file.
+        """
+        path = mrl[7:] if mrl.startswith('file://') else mrl
+        if '://' in path:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return '%x:%x:%d' % (st.st_dev, st.st_ino, st.st_size)
+
+
+    def get(self, key):
+        """
+        Returns the stored position for the key, or None.
+        """
+        entry = self._positions.get(key)
+        return entry[0] if entry else None
+
+
+    def set(self, key, position):
+        """
+        Stores a position in memory.  It is written to disk by the next
+        flush(), which happens within the store's interval.
+        """
+        self._positions[key] = [position, time.time()]
+        self._changed()
+
+
+    def forget(self, key):
+        """
+        Removes the stored position for the key, if any.
+        """
+        if self._positions.pop(key, None):
+            self._changed()
+
+
+    def _changed(self):
+        self._dirty = True
+        if not self._flush_timer.active:
+            self._flush_timer.start(self._interval)
+
+
+    def flush(self):
+        """
+        Writes the positions to disk if they changed since the last flush.
+        """
+        self._flush_timer.stop()
+        if not self._dirty:
+            return
+        if len(self._positions) > self.entries:
+            keys = sorted(self._positions, key=lambda key: self._positions[key][1])
+            for key in keys[:len(keys) - self.entries]:
+                del self._positions[key]
+        directory = os.path.dirname(self.filename)
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd = open(tmp, 'w')
+            json.dump(self._positions, fd)
+            fd.close()
+            os.rename(tmp, self.filename)
+        except (IOError, OSError), e:
+            log.error('Unable to write resume store %s: %s', self.filename, e)
+            return
+        self._dirty = False
+
+
+def get_store(cfg):
+    """
+    Returns the ResumeStore for the resume config group, opening it on first
+    use.
+    """
+    filename = os.path.expanduser(cfg.file)
+    if filename not in _stores:
+        _stores[filename] = ResumeStore(filename, cfg.interval, cfg.entries)
+        # Positions changed in the last interval must not get lost.
+        kaa.main.signals['shutdown'].connect(_stores[filename].flush)
+    return _stores[filename]
@@ -0,0 +1,170 @@
+# -*- coding: iso-8859-1 -*-
+# $Id$
+# -----------------------------------------------------------------------------
+# shm.py - Shared memory ring buffer for decoded video frames
+# -----------------------------------------------------------------------------
+# kaa.popcorn - Generic Player API
+# Copyright (C) 2008 Jason Tackaberry, Dirk Meyer
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+# -----------------------------------------------------------------------------
+
+"""
+Backends supporting CAP_VO_SHM write decoded frames into a FrameRing, a ring
+of fixed size slots in a memory mapped file (in /dev/shm if available), from
+which they can be read without copying, either in-process or by any other
+process mapping the same file.
+
+Layout of the file, all integers little endian::
+
+    header   magic 'PCRN', version, slots, slot size, width, height,
+             fourcc, sequence number of the last complete frame
+    slots    per slot: sequence number of the frame in it, timestamp
+    data     the slots, each aligned to 64 bytes, starting at a page boundary
+
+Frames are numbered from 1.  A slot's sequence number is 0 while the writer
+fills it, so a reader can tell if the frame it looks at was overwritten: it
+is still valid as long as valid() is True for its sequence number.
+"""
+
+__all__ = [ 'FrameRing' ]
+
+# python imports
+import os
+import mmap
+import time
+import struct
+import tempfile
+import logging
+
+# get logging object
+log = logging.getLogger('popcorn')
+
+MAGIC = 'PCRN'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIII4sQ')
+SLOT = struct.Struct('<Qd')
+HEADER_SIZE = 64
+
+def _align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+class FrameRing(object):
+    """
+    Ring buffer of video frames in shared memory.
+
+    @param slots: number of frames the ring holds
+    @param size: size of a frame in bytes
+    @param width, height, fourcc: frame format, stored in the header for
+        readers in other processes.  fourcc is e.g. 'I420'.
+    """
+    def __init__(self, slots, size, width=0, height=0, fourcc='I420'):
+        self.slots = slots
+        self.size = size
+        self.width = width
+        self.height = height
+        self.fourcc = fourcc
+        self._slot_stride = _align(size, 64)
+        self._data = _align(HEADER_SIZE + slots * SLOT.size, mmap.PAGESIZE)
+        self._seq = 0
+
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, self.filename = tempfile.mkstemp(prefix='popcorn-frames-', dir=directory)
+        try:
+            os.ftruncate(fd, self._data + slots * self._slot_stride)
+            self._mmap = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, slots, size, width, height, fourcc, 0)
+        log.debug('Created frame ring %s: %d slots of %d bytes', self.filename, slots, size)
+
+
+    @property
+    def seq(self):
+        """
+        Sequence number of the last complete frame, 0 if there is none yet.
+        """
+        return HEADER.unpack_from(self._mmap, 0)[-1]
+
+
+    def _slot(self, seq):
+        return (seq - 1) % self.slots
+
+
+    def write(self, data):
+        """
+        Copies a frame into the next slot and returns its sequence number.
+        """
+        seq = self._seq + 1
+        slot = self._slot(seq)
+        offset = self._data + slot * self._slot_stride
+        SLOT.pack_into(self._mmap, HEADER_SIZE + slot * SLOT.size, 0, 0.0)
+        self._mmap[offset:offset + len(data)] = data
+        SLOT.pack_into(self._mmap, HEADER_SIZE + slot * SLOT.size, seq, time.time())
+        struct.pack_into('<Q', self._mmap, HEADER.size - 8, seq)
+        self._seq = seq
+        return seq
+
+
+    def valid(self, seq):
+        """
+        Returns True if the frame with the given sequence number is still in
+        the ring.
+        """
+        return seq > 0 and SLOT.unpack_from(self._mmap, HEADER_SIZE + self._slot(seq) * SLOT.size)[0] == seq
+
+
+    def frame(self, seq=None):
+        """
+        Returns (seq, timestamp, data) for the frame with the given sequence
+        number, or the last complete frame if seq is None.  Returns None if
+        the frame is not (or no longer) in the ring.
+
+        data references the shared memory directly: a NumPy array of uint8
+        if NumPy is available, a buffer otherwise.  It is only meaningful as
+        long as valid(seq) is True, so check that after using it.
+        """
+        if seq is None:
+            seq = self.seq
+        slot = self._slot(seq)
+        slot_seq, timestamp = SLOT.unpack_from(self._mmap, HEADER_SIZE + slot * SLOT.size)
+        if not seq or slot_seq != seq:
+            return None
+        offset = self._data + slot * self._slot_stride
+        try:
+            import numpy
+        except ImportError:
+            # Python 2 can't create a memoryview of an mmap.
+            data = buffer(self._mmap, offset, self.size)
+        else:
+            data = numpy.frombuffer(self._mmap, numpy.uint8, self.size, offset)
+        return seq, timestamp, data
+
+
+    def close(self):
+        """
+        Removes the backing file.  The mapping itself is released once the
+        ring and all frames taken from it are garbage collected, so frames
+        still held by the caller never reference unmapped memory.
+        """
+        if self.filename:
+            try:
+                os.unlink(self.filename)
+            except OSError:
+                pass
+            self.filename = None
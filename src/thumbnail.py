@@ -0,0 +1,191 @@
+# -*- coding: iso-8859-1 -*-
+# $Id$
+# -----------------------------------------------------------------------------
+# thumbnail.py - Batched frame extraction with an on-disk cache
+# -----------------------------------------------------------------------------
+# kaa.popcorn - Generic Player API
+# Copyright (C) 2008 Jason Tackaberry, Dirk Meyer
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'thumbnail' ]
+
+# python imports
+import os
+import shutil
+import hashlib
+import tempfile
+import logging
+
+# kaa imports
+import kaa
+import kaa.utils
+
+# kaa.popcorn imports
+from config import config
+from utils import JobPool
+
+# get logging object
+log = logging.getLogger('popcorn.thumbnail')
+
+# JobPool bounding the number of MPlayer children extracting frames; created
+# on first use from config.thumbnail.jobs.
+_pool = None
+
+EXTENSIONS = { 'png': 'png', 'jpeg': 'jpg' }
+
+
+def _cache_key(mrl, position, size, format):
+    """
+    Returns the name of the cache file for a frame.  It is derived from the
+    identity of the content (for local files including size and
+    modification time, so changed files get new thumbnails) and the
+    extraction parameters.
+    """
+    ident = [mrl, '%.3f' % position, size, format]
+    path = mrl[7:] if mrl.startswith('file://') else mrl
+    if '://' not in path and os.path.exists(path):
+        st = os.stat(path)
+        ident[0] = os.path.abspath(path)
+        ident.extend((st.st_size, int(st.st_mtime)))
+    return '%s.%s' % (hashlib.sha1(repr(ident)).hexdigest(), EXTENSIONS[format])
+
+
+def _evict(cachedir, limit):
+    """
+    Removes the least recently used thumbnails until the cache is no larger
+    than limit bytes.  Cache hits touch the file, so the modification time
+    is the time of last use.
+    """
+    files, total = [], 0
+    for name in os.listdir(cachedir):
+        path = os.path.join(cachedir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    files.sort()
+    while files and total > limit:
+        mtime, size, path = files.pop(0)
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def _uniform_step(positions):
+    """
+    Returns the step between the positions if they are evenly spaced by a
+    whole number of seconds (which is what -sstep accepts), otherwise None.
+    """
+    if len(positions) < 2:
+        return None
+    step = positions[1] - positions[0]
+    if step < 1 or step != int(step):
+        return None
+    for a, b in zip(positions, positions[1:]):
+        if abs(b - a - step) > 0.001:
+            return None
+    return int(step)
+
+
+@kaa.coroutine()
+def _extract(mrl, start, count, step, size, format):
+    """
+    Extracts count frames starting at the given position, step seconds
+    apart, in one MPlayer run.  Returns a new temporary directory, which the
+    caller must remove, and the sorted list of the image files in it.
+    """
+    mplayer = config.mplayer.path or kaa.utils.which('mplayer')
+    if not mplayer:
+        raise IOError('No mplayer executable found in PATH')
+    tmpdir = tempfile.mkdtemp(prefix='popcorn-thumb-')
+    args = [ '-nosound', '-nocache', '-noconsolecontrols', '-vo', '%s:outdir=%s' % (format, tmpdir),
+             '-ss', '%.3f' % start, '-frames', str(count) ]
+    if step:
+        args.extend(('-sstep', str(step)))
+    if size:
+        # A height of -3 keeps the aspect.
+        args.extend(('-vf', 'scale=%d:%d' % (size[0], size[1] or -3)))
+    args.append(mrl)
+    log.debug('Extracting %d frames from %s', count, mrl)
+    yield kaa.Process(mplayer).start(args)
+    yield tmpdir, sorted(os.path.join(tmpdir, name) for name in os.listdir(tmpdir))
+
+
+@kaa.coroutine()
+def thumbnail(mrl, positions=(0,), size=None):
+    """
+    Extracts frames from a video as image files.
+
+    @param mrl: file name or URL of the video
+    @param positions: positions in seconds of the frames to extract
+    @param size: (width, height) to scale the frames to; if height is 0, it
+        is derived from the aspect.  If None, the frames are not scaled.
+    @returns: InProgress finished with a list of image file names (in the
+        thumbnail cache), one per position, or None for each frame that
+        couldn't be extracted (e.g. beyond the end of the stream).
+
+    Evenly spaced positions are extracted in a single MPlayer run.  At most
+    config.thumbnail.jobs MPlayer children run at the same time, over all
+    calls.
+    """
+    global _pool
+    cfg = config.thumbnail
+    format = cfg.format
+    cachedir = os.path.expanduser(cfg.cachedir)
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    if _pool is None:
+        _pool = JobPool(cfg.jobs)
+
+    positions = [ float(pos) for pos in positions ]
+    files = [ os.path.join(cachedir, _cache_key(mrl, pos, size, format)) for pos in positions ]
+    missing = []
+    for pos, fname in zip(positions, files):
+        if os.path.exists(fname):
+            # Mark as recently used for _evict().
+            os.utime(fname, None)
+        elif pos not in missing:
+            missing.append(pos)
+
+    if missing:
+        missing.sort()
+        step = _uniform_step(missing)
+        if step:
+            jobs = [ _pool.run(_extract, mrl, missing[0], len(missing), step, size, format) ]
+            batches = [ missing ]
+        else:
+            jobs = [ _pool.run(_extract, mrl, pos, 1, 0, size, format) for pos in missing ]
+            batches = [ [pos] for pos in missing ]
+        yield kaa.InProgressAll(*jobs)
+        for job, batch in zip(jobs, batches):
+            try:
+                tmpdir, images = job.result
+            except Exception, e:
+                log.warning('Unable to extract frames from %s: %s', mrl, e)
+                continue
+            for pos, image in zip(batch, images):
+                shutil.move(image, os.path.join(cachedir, _cache_key(mrl, pos, size, format)))
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        _evict(cachedir, cfg.cachesize * 1024 * 1024)
+
+    yield [ fname if os.path.exists(fname) else None for fname in files ]
@@ -0,0 +1,337 @@
+# -*- coding: iso-8859-1 -*-
+# $Id$
+# -----------------------------------------------------------------------------
+# utils.py - Utility functions shared between core and backends
+# -----------------------------------------------------------------------------
+# kaa.popcorn - Generic Player API
+# Copyright (C) 2008 Jason Tackaberry, Dirk Meyer
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'apply_process_policy', 'lazy_isinstance', 'cpu_count', 'JobPool', 'prefetch', 'parse_media' ]
+
+# python imports
+import os
+import sys
+import platform
+import logging
+
+# kaa imports
+import kaa
+
+# get logging object
+log = logging.getLogger('popcorn')
+
+# ioprio_set(2) has no glibc wrapper, so we need the syscall number, which
+# depends on the architecture.
+IOPRIO_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i486': 289,
+    'i586': 289,
+    'i686': 289,
+    'armv6l': 314,
+    'armv7l': 314,
+    'aarch64': 30,
+    'ppc': 273,
+    'ppc64': 273,
+}
+IOPRIO_CLASSES = { 'rt': 1, 'be': 2, 'idle': 3 }
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+PRIO_PROCESS = 0
+POSIX_FADV_WILLNEED = 3
+
+# Lazily loaded ctypes handle to libc.
+_libc = None
+
+# Number of children currently pinned to each CPU by the 'auto' affinity
+# policy, and the CPU each of those children (by pid) was given.
+_cpu_load = {}
+_pid_cpu = {}
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        import ctypes
+        # CDLL(None) gives us the symbols of the running executable, which
+        # includes libc, and avoids the expensive ctypes.util.find_library().
+        _libc = ctypes.CDLL(None, use_errno=True)
+    return _libc
+
+
+def _check(result, what):
+    if result < 0:
+        import ctypes
+        err = ctypes.get_errno()
+        raise OSError(err, '%s: %s' % (what, os.strerror(err)))
+
+
+def _parse_cpus(value):
+    """
+    Parses a cpu list in taskset(1) syntax (e.g. '0,2-3') into a sorted list
+    of CPU numbers.
+    """
+    cpus = set()
+    for part in value.replace(' ', '').split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def _online_cpus():
+    try:
+        return range(os.sysconf('SC_NPROCESSORS_ONLN'))
+    except (ValueError, OSError):
+        return [0]
+
+
+def _set_affinity(pid, cpus):
+    import ctypes
+    nwords = max(cpus) / 64 + 1
+    mask = (ctypes.c_ulong * nwords)()
+    for cpu in cpus:
+        mask[cpu / 64] |= 1 << (cpu % 64)
+    _check(_get_libc().sched_setaffinity(pid, ctypes.sizeof(mask), mask), 'sched_setaffinity')
+
+
+def _set_nice(pid, nice):
+    _check(_get_libc().setpriority(PRIO_PROCESS, pid, nice), 'setpriority')
+
+
+def _set_ioprio(pid, value):
+    if '/' in value:
+        cls, data = value.split('/', 1)
+        data = int(data)
+    else:
+        cls, data = value, 0
+    if cls not in IOPRIO_CLASSES:
+        raise ValueError('invalid I/O priority class: %s' % cls)
+    nr = IOPRIO_SYSCALLS.get(platform.machine())
+    if nr is None:
+        raise OSError('ioprio_set unsupported on %s' % platform.machine())
+    prio = (IOPRIO_CLASSES[cls] << IOPRIO_CLASS_SHIFT) | data
+    _check(_get_libc().syscall(nr, IOPRIO_WHO_PROCESS, pid, prio), 'ioprio_set')
+
+
+def _set_cgroup(pid, path):
+    # cgroup v2 uses cgroup.procs, v1 hierarchies also accept tasks.
+    for name in ('cgroup.procs', 'tasks'):
+        fname = os.path.join(path, name)
+        if os.path.exists(fname):
+            fd = open(fname, 'w')
+            try:
+                fd.write('%d\n' % pid)
+            finally:
+                fd.close()
+            return
+    raise OSError('%s is not a cgroup directory' % path)
+
+
+def _fadvise(fd, offset, length, advice):
+    import ctypes
+    libc = _get_libc()
+    # Offset and length are off_t, which is a long on 32-bit builds without
+    # large file support; posix_fadvise64() takes 64-bit values everywhere.
+    func, off_t = getattr(libc, 'posix_fadvise64', None), ctypes.c_int64
+    if func is None:
+        func, off_t = libc.posix_fadvise, ctypes.c_long
+    # posix_fadvise() returns the error number instead of setting errno.
+    err = func(fd, off_t(offset), off_t(length), advice)
+    if err:
+        raise OSError(err, 'posix_fadvise: %s' % os.strerror(err))
+
+
+def _release_cpu(pid):
+    cpu = _pid_cpu.pop(pid, None)
+    if cpu is not None:
+        _cpu_load[cpu] -= 1
+
+
+def apply_process_policy(child, cfg):
+    """
+    Applies the scheduling policy from the given process config group to a
+    freshly started child process.
+
+    @param child: a started kaa.Process object
+    @param cfg: the 'process' config group (usually player.config.process)
+
+    Every setting is best effort: failures (e.g. lacking privileges to lower
+    the nice level) are logged and otherwise ignored.  If the affinity is
+    'auto', the child is pinned to the CPU currently running the fewest
+    children, and the CPU is handed back once the child exits.
+    """
+    pid = child.pid
+    if not pid:
+        return
+
+    if cfg.affinity:
+        try:
+            if cfg.affinity == 'auto':
+                cpu = min(_online_cpus(), key=lambda cpu: _cpu_load.get(cpu, 0))
+                _set_affinity(pid, [cpu])
+                _cpu_load[cpu] = _cpu_load.get(cpu, 0) + 1
+                _pid_cpu[pid] = cpu
+                child.signals['finished'].connect(lambda code: _release_cpu(pid))
+            else:
+                _set_affinity(pid, _parse_cpus(cfg.affinity))
+        except (OSError, ValueError), e:
+            log.warning('Unable to set CPU affinity of pid %d: %s', pid, e)
+
+    if cfg.nice:
+        try:
+            _set_nice(pid, cfg.nice)
+        except OSError, e:
+            log.warning('Unable to set nice level of pid %d: %s', pid, e)
+
+    if cfg.ioprio:
+        try:
+            _set_ioprio(pid, cfg.ioprio)
+        except (OSError, ValueError), e:
+            log.warning('Unable to set I/O priority of pid %d: %s', pid, e)
+
+    if cfg.cgroup:
+        try:
+            _set_cgroup(pid, cfg.cgroup)
+        except (OSError, IOError), e:
+            log.warning('Unable to move pid %d into cgroup: %s', pid, e)
+
+
+def lazy_isinstance(obj, module, name):
+    """
+    Returns True if obj is an instance of the class with the given name in the
+    given module (e.g. 'kaa.display', 'X11Window').  The module is never
+    imported: if it has not been imported yet, obj can't be an instance.
+    """
+    mod = sys.modules.get(module)
+    return mod is not None and isinstance(obj, getattr(mod, name))
+
+
+def cpu_count():
+    """
+    Returns the number of online CPUs.
+    """
+    return len(_online_cpus())
+
+
+class JobPool(object):
+    """
+    Bounds the number of concurrently running jobs (usually coroutines
+    waiting on a child process).  Jobs beyond the limit wait until one of
+    the running jobs is finished.
+
+    @param size: maximum number of concurrent jobs; if 0, the number of CPUs
+    """
+    def __init__(self, size=0):
+        self.size = size or cpu_count()
+        self.active = 0
+        self._done = kaa.Signal()
+
+
+    @kaa.coroutine()
+    def run(self, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) once there is a free slot.
+
+        @returns: InProgress finished with the result of func, which may
+            itself return an InProgress.
+        """
+        while self.active >= self.size:
+            yield kaa.inprogress(self._done)
+        self.active += 1
+        try:
+            result = func(*args, **kwargs)
+            if isinstance(result, kaa.InProgress):
+                result = yield result
+        finally:
+            self.active -= 1
+            self._done.emit()
+        yield result
+
+
+# One thread for all prefetches, so they don't compete for the disk.
+kaa.register_thread_pool('popcorn::prefetch', kaa.ThreadPool(size=1))
+
+@kaa.threaded('popcorn::prefetch')
+def _read_ahead(path, nbytes):
+    fd = open(path, 'rb')
+    try:
+        done = 0
+        while done < nbytes:
+            data = fd.read(min(nbytes - done, 1024 * 1024))
+            if not data:
+                break
+            done += len(data)
+        return done
+    finally:
+        fd.close()
+
+
+def prefetch(path, nbytes):
+    """
+    Pulls the beginning of a local file into the page cache, so a player
+    opening it next doesn't stall on disk seeks or network file system
+    latency.
+
+    @param path: local file name
+    @param nbytes: number of bytes from the beginning of the file to read
+    @returns: InProgress finished with the number of bytes read
+
+    The kernel is asked to read ahead the first nbytes and the last
+    megabyte (where many containers keep their index) with
+    posix_fadvise(WILLNEED), then the first nbytes are read in a thread
+    in case the file system ignores the advice (e.g. some NFS setups).
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            _fadvise(fd, 0, nbytes, POSIX_FADV_WILLNEED)
+            if size > nbytes:
+                tail = max(nbytes, size - 1024 * 1024)
+                _fadvise(fd, tail, size - tail, POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except (OSError, AttributeError), e:
+        # AttributeError: libc without posix_fadvise.
+        log.debug('Unable to advise kernel to prefetch %s: %s', path, e)
+    return _read_ahead(path, nbytes)
+
+
+def parse_media(mrl):
+    """
+    Returns the kaa.metadata Media object for mrl (a dummy one if
+    kaa.metadata can't parse it), with the scheme of its URL in the scheme
+    attribute.
+    """
+    # kaa.metadata is expensive to import, so defer it to the first use.
+    import kaa.metadata
+    media = kaa.metadata.parse(mrl)
+    if not media:
+        # unable to detect, create dummy media object.
+        if '://' not in mrl:
+            mrl = 'file://' + mrl
+        media = kaa.metadata.Media(hash=dict(url=mrl, media='MEDIA_UNKNOWN'))
+    media.scheme = media.url[:media.url.find(':/')]
+    return media
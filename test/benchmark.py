@@ -0,0 +1,316 @@
+"""
+Benchmarks for the Player state machine and the backend hot paths.
+
+Runs against the fake mplayer in this directory, so the numbers are
+reproducible on any box and can be compared between releases:
+
+    python benchmark.py -n 10 -o before.json
+    python benchmark.py -n 10 -o after.json
+
+Usage: python benchmark.py [options] [benchmark ...]
+
+If no benchmarks are given, all are run.  Latencies are reported in
+milliseconds as percentiles over all samples, throughputs per second.
+"""
+
+import os
+import sys
+import time
+import json
+import optparse
+
+import kaa
+import kaa.popcorn
+from kaa.popcorn.backends import manager
+
+FAKE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakemplayer.py')
+
+BENCHMARKS = []
+RESULTS = {}
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def percentiles(samples, scale=1000.0):
+    """
+    Returns min, mean, max and the 50/90/99th percentiles of the samples.
+    Latencies are given in seconds and reported in milliseconds.
+    """
+    if not samples:
+        return {'n': 0}
+    samples = sorted(x * scale for x in samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))]
+    return {
+        'n': len(samples),
+        'min': samples[0],
+        'mean': sum(samples) / len(samples),
+        'p50': pick(0.5),
+        'p90': pick(0.9),
+        'p99': pick(0.99),
+        'max': samples[-1],
+    }
+
+
+def report(name, result):
+    RESULTS[name] = result
+    if 'p50' in result:
+        print '  %-28s n=%-5d p50=%8.2f p90=%8.2f p99=%8.2f max=%8.2f ms' % \
+              (name, result['n'], result['p50'], result['p90'], result['p99'], result['max'])
+    else:
+        print '  %-28s %12.0f /s' % (name, result['rate'])
+
+
+def throughput(func, count):
+    """
+    Calls func(count) and returns the number of operations per second.
+    """
+    t0 = time.time()
+    func(count)
+    return {'rate': count / (time.time() - t0), 'count': count}
+
+
+def new_player():
+    p = kaa.popcorn.Player()
+    p.window = None
+    return p
+
+
+def dummy_media(url, media='MEDIA_UNKNOWN'):
+    import kaa.metadata
+    m = kaa.metadata.Media(hash=dict(url=url, media=media))
+    m.scheme = url[:url.find(':/')]
+    return m
+
+
+@benchmark
+@kaa.coroutine()
+def player(opts):
+    """
+    open -> STATE_OPEN, play -> start signal, seek round trip and stop
+    latency with N concurrent players.
+    """
+    samples = {'open': [], 'start': [], 'seek': [], 'stop': []}
+
+    @kaa.coroutine()
+    def run(n):
+        p = new_player()
+        for r in range(opts.rounds):
+            t0 = time.time()
+            yield p.open('bench-%d-%d.avi' % (n, r))
+            samples['open'].append(time.time() - t0)
+
+            t0 = time.time()
+            p.signals['start'].connect_once(lambda: samples['start'].append(time.time() - t0))
+            yield p.play()
+
+            t0 = time.time()
+            yield p.seek(10)
+            samples['seek'].append(time.time() - t0)
+
+            t0 = time.time()
+            yield p.stop()
+            samples['stop'].append(time.time() - t0)
+
+    yield kaa.InProgressAll(*[ run(n) for n in range(opts.players) ])
+    for name in ('open', 'start', 'seek', 'stop'):
+        report('player.%s' % name, percentiles(samples[name]))
+
+
+@benchmark
+@kaa.coroutine()
+def proxy(opts):
+    """
+    Overhead of the proxy layer: open, play, seek and stop with the
+    in-process null backend, for 100 times as many players.
+    """
+    samples = {'open': [], 'play': [], 'seek': [], 'stop': []}
+
+    @kaa.coroutine()
+    def run(n):
+        p = new_player()
+        for r in range(opts.rounds):
+            for name, func, args in (('open', p.open, ('null-%d.avi' % n, None, 'null')),
+                                     ('play', p.play, ()), ('seek', p.seek, (10,)),
+                                     ('stop', p.stop, ())):
+                t0 = time.time()
+                yield func(*args)
+                samples[name].append(time.time() - t0)
+
+    yield kaa.InProgressAll(*[ run(n) for n in range(opts.players * 100) ])
+    for name in ('open', 'play', 'seek', 'stop'):
+        report('proxy.%s' % name, percentiles(samples[name]))
+
+
+@benchmark
+@kaa.coroutine()
+def stream(opts):
+    """
+    Property access through player.stream and backend methods called
+    through the player, with the null backend playing.
+    """
+    p = new_player()
+    yield p.open('null-stream.avi', None, 'null')
+    yield p.play()
+    stream = p.stream
+
+    def read(count):
+        for i in xrange(count):
+            stream.position
+
+    def write(count):
+        for i in xrange(count):
+            stream.audio_delay = 0.1
+
+    def proxied(count):
+        # reset() is not a Player method, so it is proxied to the backend,
+        # where it is a no-op.
+        for i in xrange(count):
+            p.reset()
+
+    report('stream.read', throughput(read, opts.count))
+    report('stream.write', throughput(write, opts.count))
+    report('stream.proxied', throughput(proxied, opts.count))
+    yield p.stop()
+
+
+@benchmark
+def parse(opts):
+    """
+    Line-parse throughput of the MPlayer backend's _handle_child_line() for
+    status lines and identify lines.
+    """
+    from kaa.popcorn.backends.mplayer.player import MPlayer
+    p = new_player()
+    backend = p._backend = MPlayer(p)
+    backend._media = dummy_media('file:///bench.avi')
+    backend._state = kaa.popcorn.STATE_PLAYING
+
+    def status(count):
+        handle = backend._handle_child_line
+        for i in xrange(count):
+            handle('A:%6.1f V:%6.1f A-V:  0.000 ct:  0.000   0/  0  1%%  1%%  0.1%% 0 0' % (i / 25.0, i / 25.0))
+
+    def identify(count):
+        handle = backend._handle_child_line
+        for i in xrange(count):
+            handle('ID_VIDEO_WIDTH=640')
+
+    report('parse.status', throughput(status, opts.count))
+    report('parse.identify', throughput(identify, opts.count))
+
+
+@benchmark
+def transcript(opts):
+    """
+    Line-parse throughput of _handle_child_line() for the child output
+    recorded in a transcript (given with -t).
+    """
+    if not opts.transcript:
+        print '  skipped, no transcript given'
+        return
+    from kaa.popcorn.backends.mplayer.player import MPlayer
+    from kaa.popcorn.backends.mplayer import transcript
+    lines = [ text for ts, kind, text in transcript.read(opts.transcript) if kind == 'O' ]
+    if not lines:
+        print '  skipped, no child output in transcript'
+        return
+    p = new_player()
+    backend = p._backend = MPlayer(p)
+    backend._media = dummy_media('file:///bench.avi')
+    backend._state = kaa.popcorn.STATE_PLAYING
+
+    def feed(count):
+        handle = backend._handle_child_line
+        for i in xrange(count / len(lines)):
+            for line in lines:
+                handle(line)
+
+    report('transcript.lines', throughput(feed, opts.count - opts.count % len(lines)))
+
+
+@benchmark
+@kaa.coroutine()
+def identify(opts):
+    """
+    Files identified per second with one MPlayer child per file, and with
+    batches of files per child (count / 1000 files).
+    """
+    from kaa.popcorn.backends.mplayer import identify
+    files = [ 'bench-%d.avi' % n for n in range(max(opts.count / 1000, 1)) ]
+    batch = kaa.popcorn.config.mplayer.identify.batch
+
+    t0 = time.time()
+    for fname in files:
+        yield identify.identify(fname, opts.mplayer)
+    report('identify.single', {'rate': len(files) / (time.time() - t0), 'count': len(files)})
+
+    t0 = time.time()
+    for n in range(0, len(files), batch):
+        yield identify.identify_batch(files[n:n + batch], opts.mplayer)
+    report('identify.batch%d' % batch, {'rate': len(files) / (time.time() - t0), 'count': len(files)})
+
+
+@benchmark
+def selection(opts):
+    """
+    get_player_class() decisions per second.
+    """
+    manager.import_backends()
+    media = dummy_media('file:///bench.avi')
+    # First call fetches the backend capabilities, which is not what we
+    # want to measure.
+    manager.get_player_class(media)
+
+    def decide(count):
+        for i in xrange(count):
+            manager.get_player_class(media)
+
+    report('select.decide', throughput(decide, opts.count / 10))
+
+
+@kaa.coroutine()
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-n', '--players', type='int', default=1,
+                      help='number of concurrent players (default 1)')
+    parser.add_option('-r', '--rounds', type='int', default=10,
+                      help='open/play/seek/stop rounds per player (default 10)')
+    parser.add_option('-c', '--count', type='int', default=100000,
+                      help='iterations for throughput benchmarks (default 100000)')
+    parser.add_option('-m', '--mplayer', default=FAKE,
+                      help='mplayer executable (default: the fake mplayer)')
+    parser.add_option('-t', '--transcript', help='MPlayer transcript for the transcript benchmark')
+    parser.add_option('-o', '--output', help='save results as JSON to this file')
+    opts, names = parser.parse_args()
+
+    kaa.popcorn.config.mplayer.path = opts.mplayer
+    # Needed by the proxy benchmark, and must be set before the first player
+    # is opened.
+    kaa.popcorn.config.null.enabled = True
+    for func in BENCHMARKS:
+        if names and func.func_name not in names:
+            continue
+        print '%s: %s' % (func.func_name, func.__doc__.strip().split('\n')[0])
+        ip = func(opts)
+        if isinstance(ip, kaa.InProgress):
+            yield ip
+
+    if opts.output:
+        fd = open(opts.output, 'w')
+        json.dump({
+            'version': str(getattr(kaa.popcorn, 'VERSION', '')),
+            'time': time.time(),
+            'python': sys.version.split()[0],
+            'options': {'players': opts.players, 'rounds': opts.rounds, 'count': opts.count,
+                        'mplayer': opts.mplayer},
+            'results': RESULTS,
+        }, fd, indent=2, sort_keys=True)
+        fd.close()
+        print 'Results saved to', opts.output
+    sys.exit(0)
+
+
+main()
+kaa.main.run()
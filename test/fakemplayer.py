@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+"""
+Deterministic stand-in for the mplayer executable.
+
+Point kaa.popcorn at it with config.mplayer.path to run the MPlayer backend,
+the tests and the benchmarks on any box, without mplayer or real media:
+
+    kaa.popcorn.config.mplayer.path = '/path/to/test/fakemplayer.py'
+
+It implements what the backend relies on: the help output parsed by
+get_mplayer_info(), '-input keylist', '-identify' (also with several files
+in one run), '-frames 0', '-slave' with the commands the backend sends,
+'-idle', status lines, frames for '-vo yuv4mpeg' and image files for
+'-vo png' and '-vo jpeg'.  Every file exists as far as the fake is
+concerned.  The behaviour is controlled through environment variables:
+
+    FAKEMPLAYER_RATE        status lines per second while playing (25)
+    FAKEMPLAYER_LENGTH      stream length in seconds (60)
+    FAKEMPLAYER_VIDEO       0 for audio-only streams (1)
+    FAKEMPLAYER_TRANSCRIPT  transcript to replay instead of generating the
+                            output of a playback (-slave) session
+    FAKEMPLAYER_REPLAY      replay speed factor, 0 replays without delays (1)
+    FAKEMPLAYER_HANG        where to hang: 'open' (before any output),
+                            'start' (after the banner) or 'play:<secs>'
+    FAKEMPLAYER_ERROR       where to fail: 'open', 'crash' (exit right
+                            after announcing the file) or 'play:<secs>'
+
+FAKEMPLAYER_HANG and FAKEMPLAYER_ERROR may be suffixed by '@<substring>' to
+only affect files whose name contains the substring, e.g. 'open@broken',
+and hold several comma separated triggers, e.g. 'open@missing,crash@bad'.
+A hung fake ignores slave commands, but dies from SIGTERM like MPlayer.
+
+MPlayer applies options given after a file name to that file only.  The
+fake doesn't emulate that, but refuses options after the first of several
+files, so callers relying on them applying to all files are caught.
+
+Transcripts are text files (gzipped if the name ends with .gz) with one
+line per event: '<seconds>\\t<O|I>\\t<text>', where O is a line of child
+output and I a slave command sent to the child.  I lines are skipped.
+"""
+
+import os
+import sys
+import time
+import gzip
+import select
+import struct
+import zlib
+
+VERSION = 'MPlayer SVN-r33000-fake (C) 2000-2011 MPlayer Team'
+
+HELP = {
+    '-vf': ('Available video filters:', [
+        '  yadif          : Yet Another DEinterlacing Filter',
+        '  kerndeint      : Kernel Deinterlacer',
+        '  tfields        : temporal field separation',
+        '  expand         : expanding & osd',
+        '  scale          : software scaling']),
+    '-af': ('Available audio filters:', [
+        '  volume   : Volume changer',
+        '  resample : Sample frequency conversion']),
+    '-vo': ('Available video output drivers:', [
+        '\txv\tX11/Xv',
+        '\tx11\tX11 ( XImage/Shm )',
+        '\tvdpau\tVDPAU with X11',
+        '\tyuv4mpeg\tyuv4mpeg output for mjpegtools',
+        '\tpng\tPNG file',
+        '\tjpeg\tJPEG file',
+        '\tnull\tNull video output']),
+    '-ao': ('Available audio output drivers:', [
+        '\talsa\tALSA-0.9.x-1.x audio output',
+        '\toss\tOSS/ioctl audio output',
+        '\tpulse\tPulseAudio audio output',
+        '\tnull\tNull audio output']),
+    '-vc': ('Available video codecs:', [
+        'vc:         vfm:      status:   info:  [lib/dll (comment)]',
+        'ffh264vdpau ffmpeg    working   FFmpeg H.264 (VDPAU)  [h264_vdpau]',
+        'ffmpeg12vdpau ffmpeg  working   FFmpeg MPEG-1/2 (VDPAU)  [mpegvideo_vdpau]',
+        'ffh264      ffmpeg    working   FFmpeg H.264  [h264]',
+        'ffmpeg2     ffmpeg    working   FFmpeg MPEG-2  [mpeg2video]']),
+    '-ac': ('Available audio codecs:', [
+        'ac:         afm:      status:   info:  [lib/dll (comment)]',
+        'mad         libmad    working   libMAD MPEG layer 1-2-3  [libmad]',
+        'ffac3       ffmpeg    working   FFmpeg AC-3  [ac3]']),
+}
+
+KEYLIST = ['RIGHT', 'LEFT', 'UP', 'DOWN', 'ENTER', 'ESC', 'SPACE', 'PGUP', 'PGDWN',
+           'HOME', 'END', 'INS', 'DEL', 'MOUSE_BTN0', 'MOUSE_BTN1', 'MOUSE_BTN2']
+
+# Options that take a value; everything else starting with '-' is a flag.
+VALUE_OPTS = set(('-vo', '-ao', '-vf', '-af', '-vc', '-ac', '-cache', '-cache-min',
+                  '-ss', '-delay', '-wid', '-demuxer', '-osdlevel', '-dvd-device',
+                  '-frames', '-input', '-speed', '-sstep', '-lavdopts', '-endpos'))
+
+FPS = 25.0
+
+# False once stdin is closed.
+stdin_open = True
+
+
+def out(line, end='\n'):
+    sys.stdout.write(line + end)
+    sys.stdout.flush()
+
+
+def parse_args(argv):
+    """
+    Returns the options, the files, and the options given after a file.
+    """
+    opts, files, late = {}, [], []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith('-') and files:
+            late.append(arg)
+        if arg in VALUE_OPTS and i + 1 < len(argv):
+            opts[arg] = argv[i + 1]
+            i += 2
+            continue
+        if arg.startswith('-'):
+            opts[arg] = True
+        else:
+            files.append(arg)
+        i += 1
+    return opts, files, late
+
+
+def trigger(name, filename):
+    """
+    Returns the value of the FAKEMPLAYER_<name> trigger if it applies to the
+    given file, otherwise None.
+    """
+    for value in os.environ.get('FAKEMPLAYER_' + name, '').split(','):
+        if '@' in value:
+            value, pattern = value.split('@', 1)
+            if pattern not in filename:
+                continue
+        if value:
+            return value
+    return None
+
+
+def hang():
+    while True:
+        time.sleep(3600)
+
+
+def identify(filename, video):
+    length = float(os.environ.get('FAKEMPLAYER_LENGTH', 60))
+    info = [('FILENAME', filename)]
+    if video:
+        info += [('VIDEO_FORMAT', 'H264'), ('VIDEO_BITRATE', 2000000), ('VIDEO_WIDTH', 640),
+                 ('VIDEO_HEIGHT', 480), ('VIDEO_FPS', '%.3f' % FPS), ('VIDEO_ASPECT', '1.3333')]
+    info += [('AUDIO_FORMAT', '8192'), ('AUDIO_BITRATE', 192000), ('AUDIO_RATE', 48000),
+             ('AUDIO_NCH', 2), ('LENGTH', '%.2f' % length), ('SEEKABLE', 1)]
+    for key, value in info:
+        out('ID_%s=%s' % (key, value))
+    if video:
+        out('ID_VIDEO_CODEC=ffh264')
+    out('ID_AUDIO_CODEC=ffac3')
+
+
+def open_file(filename, opts):
+    """
+    Prints the output for opening the file.  Returns False if it fails.
+    """
+    out('')
+    out('Playing %s.' % filename)
+    if trigger('HANG', filename) == 'open':
+        hang()
+    if trigger('ERROR', filename) == 'crash':
+        os._exit(139)
+    if trigger('ERROR', filename) == 'open':
+        out("File not found: '%s'" % filename)
+        out('Failed to open %s.' % filename)
+        return False
+    if '-identify' in opts:
+        identify(filename, os.environ.get('FAKEMPLAYER_VIDEO', '1') != '0')
+    return True
+
+
+def png(value):
+    """
+    Returns a valid 1x1 grayscale PNG with the given pixel value.
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+               struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)) + \
+           chunk(b'IDAT', zlib.compress(b'\x00' + bytes(bytearray([value])))) + chunk(b'IEND', b'')
+
+
+def extract(filename, opts):
+    """
+    Writes the frames for '-vo png' or '-vo jpeg' to the output directory,
+    honoring -ss, -sstep and -frames.
+    """
+    length = float(os.environ.get('FAKEMPLAYER_LENGTH', 60))
+    vo = str(opts['-vo']).split(',')[0].split(':')
+    outdir = dict(x.split('=', 1) for x in vo[1:] if '=' in x).get('outdir', '.')
+    pos, step = float(opts.get('-ss', 0)), float(opts.get('-sstep', 0))
+    for n in range(1, int(opts['-frames']) + 1):
+        if pos >= length:
+            break
+        if vo[0] == 'png':
+            data = png(int(pos) % 256)
+        else:
+            # Not a decodable JPEG, only the markers.
+            data = b'\xff\xd8' + bytes(bytearray([int(pos) % 256])) + b'\xff\xd9'
+        fd = open(os.path.join(outdir, '%08d.%s' % (n, 'png' if vo[0] == 'png' else 'jpg')), 'wb')
+        fd.write(data)
+        fd.close()
+        pos += step if step else 1.0 / FPS
+
+
+def read_commands(timeout):
+    """
+    Waits up to timeout seconds for slave commands and returns them.
+    """
+    global stdin_open
+    commands = []
+    if not stdin_open:
+        time.sleep(max(timeout, 0))
+        return commands
+    r = select.select([sys.stdin], [], [], max(timeout, 0))[0]
+    if r:
+        data = os.read(sys.stdin.fileno(), 4096)
+        if not isinstance(data, str):
+            data = data.decode('latin-1')
+        if not data:
+            # stdin closed, there will be no more commands.
+            stdin_open = False
+        for cmd in data.splitlines():
+            words = cmd.split()
+            if words and words[0] in ('pausing', 'pausing_keep', 'pausing_toggle', 'pausing_keep_force'):
+                words = words[1:]
+            if words:
+                commands.append(words)
+    return commands
+
+
+def replay(path):
+    """
+    Replays the child output recorded in a transcript, while still obeying
+    the quit command.
+    """
+    speed = float(os.environ.get('FAKEMPLAYER_REPLAY', 1))
+    fd = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    t0 = time.time()
+    for line in fd:
+        if not isinstance(line, str):
+            line = line.decode('latin-1')
+        line = line.rstrip('\n')
+        if not line or line.startswith('#'):
+            continue
+        ts, kind, text = line.split('\t', 2)
+        if kind != 'O':
+            continue
+        if speed:
+            delay = t0 + float(ts) / speed - time.time()
+            while delay > 0:
+                for cmd in read_commands(delay):
+                    if cmd[0] == 'quit':
+                        sys.exit(0)
+                delay = t0 + float(ts) / speed - time.time()
+        # Status lines are terminated by \r, everything else by \n.
+        out(text, '\r' if text.startswith('A:') or text.startswith('V:') else '\n')
+    sys.exit(0)
+
+
+def play(filename, opts):
+    """
+    Plays the file in slave mode.  Returns when the file is finished, or
+    exits the process when told to quit.
+    """
+    length = float(os.environ.get('FAKEMPLAYER_LENGTH', 60))
+    rate = float(os.environ.get('FAKEMPLAYER_RATE', 25))
+    video = os.environ.get('FAKEMPLAYER_VIDEO', '1') != '0' and '-novideo' not in opts
+    hang_at, error_at = trigger('HANG', filename), trigger('ERROR', filename)
+
+    if hang_at == 'start':
+        hang()
+    frames = None
+    if video:
+        vo = str(opts.get('-vo', 'xv')).split(',')[0]
+        if vo.startswith('yuv4mpeg'):
+            # Small 64x48 I420 frames, each filled with the frame number.
+            path = vo.partition('file=')[2].split(':')[0] or 'stream.yuv'
+            frames = open(path, 'wb')
+            frames.write(b'YUV4MPEG2 W64 H48 F25:1 Ip A1:1 C420jpeg\n')
+            out('VO: [yuv4mpeg] 64x48 => 64x48 Planar YV12')
+        else:
+            out('VO: [%s] 640x480 => 640x480 Planar YV12' % vo.split(':')[0])
+    ao = str(opts.get('-ao', 'alsa')).split(',')[0].split(':')[0]
+    out('AO: [%s] 48000Hz 2ch s16le (2 bytes per sample)' % ao)
+    if '-cache' in opts:
+        # Fill the cache up to -cache-min in a few steps.
+        size, fill = int(opts['-cache']), float(opts.get('-cache-min', 20))
+        out('Cache size set to %d KBytes' % size)
+        for n in range(1, 5):
+            out('Cache fill: %5.2f%% (%d bytes)   ' % (fill * n / 4, size * 1024 * fill * n / 400), '\r')
+            time.sleep(0.05)
+    out('Starting playback...')
+
+    pos = float(opts.get('-ss', 0))
+    speed = float(opts.get('-speed', 1))
+    paused = muted = False
+    started = last = time.time()
+    while True:
+        now = time.time()
+        if hang_at and hang_at.startswith('play:') and now - started >= float(hang_at[5:]):
+            hang()
+        if error_at and error_at.startswith('play:') and now - started >= float(error_at[5:]):
+            out('FATAL: fake error')
+            sys.exit(1)
+
+        if not paused:
+            pos += (now - last) * speed
+        last = now
+        if pos >= length:
+            out('')
+            out('EOF code: 1  ')
+            return
+
+        if not paused:
+            status = 'A:%6.1f V:%6.1f A-V:  0.000 ct:  0.000   0/  0  1%%  1%%  0.1%% 0 0' % (pos, pos)
+            if speed != 1:
+                status += ' %4.2fx' % speed
+            out(status, '\r')
+            if frames:
+                try:
+                    frames.write(b'FRAME\n' + bytes(bytearray([int(pos * FPS) % 256])) * (64 * 48 * 3 // 2))
+                    frames.flush()
+                except (IOError, OSError):
+                    # Reader is gone.
+                    frames = None
+
+        for cmd in read_commands(1.0 / rate if not paused else 1.0):
+            name, args = cmd[0], cmd[1:]
+            if name == 'quit':
+                out('')
+                out('Exiting... (Quit)')
+                sys.exit(0)
+            elif name == 'pause':
+                paused = not paused
+                if paused:
+                    out('ID_PAUSED')
+            elif name == 'seek' and args:
+                kind = int(args[1]) if len(args) > 1 else 0
+                value = float(args[0])
+                pos = [pos + value, length * value / 100.0, value][kind]
+                pos = min(max(pos, 0), length)
+            elif name == 'frame_step':
+                pos += 1.0 / FPS
+                out('A:%6.1f V:%6.1f A-V:  0.000 ct:  0.000   0/  0  1%%  1%%  0.1%% 0 0' % (pos, pos), '\r')
+                paused = True
+                out('ID_PAUSED')
+            elif name == 'mute':
+                muted = bool(int(args[0])) if args else not muted
+            elif name == 'get_property' and args == ['mute']:
+                out('ANS_mute=%s' % ('yes' if muted else 'no'))
+            elif name == 'speed_set' and args:
+                speed = float(args[0])
+            elif name == 'speed_mult' and args:
+                speed *= float(args[0])
+            elif name == 'speed_incr' and args:
+                speed += float(args[0])
+            elif name == 'loadfile' and args:
+                return args[0]
+
+
+def main(argv):
+    opts, files, late = parse_args(argv)
+    if late and len(files) > 1:
+        out('fake mplayer: %s given after the first of several files' % ' '.join(late))
+        return 1
+    if 'help' in opts.values():
+        # get_mplayer_info() asks for all help lists at once.
+        out(VERSION)
+        for opt in ('-vf', '-af', '-vo', '-ao', '-vc', '-ac'):
+            if opts.get(opt) == 'help' or opt in opts:
+                header, lines = HELP[opt]
+                out(header)
+                for line in lines:
+                    out(line)
+        return 0
+    if opts.get('-input') == 'keylist':
+        for key in KEYLIST:
+            out(key)
+        return 0
+
+    out(VERSION)
+    if opts.get('-frames') == '0':
+        # Identify only, possibly several files in one run.
+        failed = 0
+        for filename in files:
+            if not open_file(filename, opts):
+                failed += 1
+        out('')
+        out('Exiting... (End of file)')
+        return 1 if failed == len(files) else 0
+
+    if '-slave' in opts and os.environ.get('FAKEMPLAYER_TRANSCRIPT'):
+        replay(os.environ['FAKEMPLAYER_TRANSCRIPT'])
+
+    queue = list(files)
+    while queue:
+        filename = queue.pop(0)
+        if not open_file(filename, opts):
+            continue
+        if '-slave' not in opts:
+            if str(opts.get('-vo')).split(':')[0] in ('png', 'jpeg') and '-frames' in opts:
+                extract(filename, opts)
+            continue
+        loaded = play(filename, opts)
+        if loaded:
+            queue.append(loaded)
+        elif not queue and '-idle' in opts:
+            # Wait for loadfile or quit.
+            while not queue:
+                for cmd in read_commands(1.0):
+                    if cmd[0] == 'quit':
+                        return 0
+                    if cmd[0] == 'loadfile' and len(cmd) > 1:
+                        queue.append(cmd[1])
+    out('')
+    out('Exiting... (End of file)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,111 @@
+"""
+Tests the caching HTTP proxy against a local stand-in HTTP server.
+
+The stand-in serves generated content, with range support on /ranged/* and
+without on /plain/*, and counts the requests it gets, so we can tell which
+reads were answered from the cache.
+
+Usage: python httpcache.py
+"""
+
+import os
+import re
+import shutil
+import urllib2
+import tempfile
+import threading
+import BaseHTTPServer
+
+from kaa.popcorn.httpcache import HTTPCache
+
+LENGTH = 1000 * 1000
+SEGMENT = 64 * 1024
+DATA = ''.join(chr(n % 251) for n in xrange(LENGTH))
+REQUESTS = []
+
+
+class Origin(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        REQUESTS.append((self.path, self.headers.get('Range')))
+        m = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if self.path.startswith('/ranged/') and m:
+            start = int(m.group(1))
+            end = min(int(m.group(2) or LENGTH - 1), LENGTH - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, LENGTH))
+        else:
+            start, end = 0, LENGTH - 1
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mpeg')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(DATA[start:end + 1])
+
+
+class OriginServer(BaseHTTPServer.HTTPServer):
+    def handle_error(self, request, client_address):
+        # The proxy closes the connection early when probing for range
+        # support.
+        pass
+
+
+def get(url, start=None, end=None):
+    request = urllib2.Request(url)
+    if start is not None:
+        request.add_header('Range', 'bytes=%d-%s' % (start, '' if end is None else end))
+    response = urllib2.urlopen(request)
+    return response.getcode(), response.read()
+
+
+def main():
+    origin = OriginServer(('127.0.0.1', 0), Origin)
+    thread = threading.Thread(target=origin.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:%d' % origin.server_address[1]
+
+    cachedir = tempfile.mkdtemp(prefix='popcorn-httpcache-test-')
+    try:
+        cache = HTTPCache(cachedir, 10 * LENGTH, SEGMENT, readahead=2)
+        url = cache.url(base + '/ranged/video.mpg')
+
+        code, data = get(url)
+        assert code == 200 and data == DATA, 'full read'
+        fetched = len(REQUESTS)
+        print 'full read: ok (%d requests to the origin)' % fetched
+
+        code, data = get(url, 100000, 299999)
+        assert code == 206 and data == DATA[100000:300000], 'range read'
+        code, data = get(url, LENGTH - 10)
+        assert code == 206 and data == DATA[-10:], 'open range read'
+        code, data = get(url)
+        assert data == DATA
+        assert len(REQUESTS) == fetched, 'cached reads went to the origin'
+        print 'cached reads: ok'
+
+        code, data = get(cache.url(base + '/plain/video.mpg'))
+        assert code == 200 and data == DATA, 'pass-through read'
+        print 'pass-through without range support: ok'
+        cache.shutdown()
+
+        # Cache of 4 segments: reading everything evicts the older segments.
+        shutil.rmtree(cachedir)
+        cache = HTTPCache(cachedir, 4 * SEGMENT, SEGMENT, readahead=0)
+        code, data = get(cache.url(base + '/ranged/video.mpg'))
+        assert data == DATA
+        size = sum(os.path.getsize(os.path.join(d, f)) for d, dirs, files in os.walk(cachedir)
+                   for f in files if f != 'info')
+        assert size <= 4 * SEGMENT, 'cache size %d above limit' % size
+        print 'eviction: ok (%d bytes cached)' % size
+        cache.shutdown()
+    finally:
+        shutil.rmtree(cachedir, ignore_errors=True)
+        origin.shutdown()
+    print 'All tests passed.'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Measures how long 'import kaa.popcorn' takes in a fresh interpreter, on
+top of 'import kaa', and checks the result against a time budget.  It also
+verifies that the heavy dependencies, which are only needed once a Player
+opens something, are not pulled in by the import.
+
+Usage: python importtime.py [runs] [budget in ms]
+"""
+
+import sys
+import subprocess
+
+RUNS = 20
+# Budget for the median import time, in milliseconds.
+BUDGET = 150
+
+# Modules that must not be loaded by 'import kaa.popcorn'.
+DEFERRED = ('kaa.metadata', 'kaa.display', 'kaa.candy')
+
+# The kaa namespace package is set up by kaa.base's installer, through
+# pkg_resources when installed with setuptools, which can cost more than
+# kaa.popcorn itself.  It is imported before the clock starts.
+MEASURE = '''
+import sys, time
+import kaa
+t0 = time.time()
+import kaa.popcorn
+print time.time() - t0
+print ' '.join(m for m in %r if m in sys.modules)
+''' % (DEFERRED,)
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+budget = float(sys.argv[2]) if len(sys.argv) > 2 else BUDGET
+
+times = []
+for i in range(runs):
+    out = subprocess.Popen([sys.executable, '-c', MEASURE], stdout=subprocess.PIPE).communicate()[0]
+    t, loaded = (out.split('\n') + [''])[:2]
+    times.append(float(t) * 1000)
+    if loaded.strip():
+        print 'FAIL: import kaa.popcorn loaded deferred modules: %s' % loaded.strip()
+        sys.exit(1)
+
+times.sort()
+median = times[len(times) / 2]
+print 'import kaa.popcorn: min %.1fms, median %.1fms, max %.1fms (%d runs)' % \
+      (times[0], median, times[-1], runs)
+if median > budget:
+    print 'FAIL: median import time exceeds budget of %.0fms' % budget
+    sys.exit(1)
+print 'OK: within budget of %.0fms' % budget
@@ -0,0 +1,69 @@
+"""
+Tests the store of resume positions: written behind, capped in size, and
+tolerant of a corrupt file.
+
+Usage: python resume.py
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+
+from kaa.popcorn.resume import ResumeStore
+
+
+def main():
+    tmp = tempfile.mkdtemp(prefix='popcorn-resume-test-')
+    try:
+        filename = os.path.join(tmp, 'cache', 'resume.json')
+        media = os.path.join(tmp, 'movie.avi')
+        open(media, 'w').write('movie')
+
+        store = ResumeStore(filename, interval=30, entries=3)
+        key = store.key(media)
+        assert key and store.key('file://' + media) == key, 'key of a local file'
+        assert store.key('http://example.com/movie.avi') is None, 'key of a URL'
+        assert store.key(os.path.join(tmp, 'missing.avi')) is None, 'key of a missing file'
+        os.rename(media, media + '.moved')
+        assert store.key(media + '.moved') == key, 'key after a rename'
+        print 'keys: ok'
+
+        store.set(key, 42.5)
+        assert store.get(key) == 42.5
+        assert not os.path.exists(filename), 'written before the flush'
+        store.flush()
+        assert json.load(open(filename))[key][0] == 42.5
+        assert ResumeStore(filename).get(key) == 42.5, 'position after reopening'
+        os.remove(filename)
+        store.flush()
+        assert not os.path.exists(filename), 'unchanged store written again'
+        store.forget(key)
+        store.flush()
+        assert ResumeStore(filename).get(key) is None, 'forgotten position'
+        print 'flush: ok'
+
+        for n in range(5):
+            store.set('file%d' % n, n + 10.0)
+            # Distinct update times, the oldest are dropped first.
+            time.sleep(0.01)
+        store.flush()
+        kept = ResumeStore(filename)
+        assert [ kept.get('file%d' % n) for n in range(5) ] == [None, None, 12.0, 13.0, 14.0]
+        print 'expiry: ok'
+
+        open(filename, 'w').write('{"truncated": [1')
+        store = ResumeStore(filename)
+        assert store.get('truncated') is None, 'position from a corrupt file'
+        store.set(key, 7.0)
+        store.flush()
+        assert ResumeStore(filename).get(key) == 7.0, 'corrupt file not replaced'
+        print 'corrupt file: ok'
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print 'All tests passed.'
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import sys
 import logging
 import time
 import os
+import signal
 
 import kaa.input.stdin
 from kaa.popcorn.backends import manager
@@ -10,6 +11,16 @@ import kaa.popcorn
 TESTCASES = []
 FILES = sys.argv[1:]
 
+# With --fake, run against the fake mplayer in this directory, which needs
+# neither real media files nor a display.
+FAKE = '--fake' in FILES
+if FAKE:
+    FILES = [ f for f in FILES if f != '--fake' ] or ['fake1.avi', 'fake2.avi']
+    kaa.popcorn.config.mplayer.path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakemplayer.py')
+# Only used when asked for with player='null'; must be enabled before the
+# first player is opened.
+kaa.popcorn.config.null.enabled = True
+
 #logging.getLogger('popcorn').setLevel(logging.DEBUG)
 #logging.getLogger('base').setLevel(logging.DEBUG)
 
@@ -20,18 +31,46 @@ def testcase(func):
     TESTCASES.append(func)
     return func
 
+def new_player():
+    p = kaa.popcorn.Player()
+    if FAKE:
+        # No video output, the fake has nothing to show.
+        p.window = None
+    return p
+
 @testcase
 @kaa.coroutine()
 def open_normal():
     """
     Straightforward open yield.
     """
-    p = kaa.popcorn.Player()
+    p = new_player()
     yield p.open(FILES[0])
     assert(p.state == kaa.popcorn.STATE_OPEN)
     yield p
 
 
+@testcase
+@kaa.coroutine()
+def play_audio_only():
+    """
+    Play a stream kaa.metadata reports as audio: MPlayer gets -novideo and
+    no window is created, so kaa.display is never imported.
+    """
+    import kaa.metadata
+    imported = 'kaa.display' in sys.modules
+    # Default window handling, which must not be touched for audio.
+    p = kaa.popcorn.Player()
+    url = 'file://' + os.path.abspath(FILES[0])
+    yield p.open(kaa.metadata.Media(hash=dict(url=url, media='MEDIA_AUDIO')))
+    yield p.play()
+    yield kaa.delay(0.5)
+    # The fake prints a VO line unless it was given -novideo.
+    assert('VO' not in p._backend._drivers and 'AO' in p._backend._drivers)
+    assert(imported or 'kaa.display' not in sys.modules)
+    yield p.stop()
+
+
 @testcase
 @kaa.coroutine()
 def open_abort_with_stop():
@@ -39,7 +78,7 @@ def open_abort_with_stop():
     Open but don't yield, then yield stop.  Tests player's ability to abort an
     open.
     """
-    p = kaa.popcorn.Player()
+    p = new_player()
     open_ip = p.open(FILES[0])
     stop_ip = p.stop()
     try:
@@ -60,7 +99,7 @@ def open_twice():
     Open but don't yield, then yield a new open.  Similar to open_abort_with_stop
     but tests internal aborting.
     """
-    p = kaa.popcorn.Player()
+    p = new_player()
     p.open(FILES[0])
     yield p.open(FILES[1])
     assert(FILES[1] in p.stream.uri)
@@ -69,7 +108,7 @@ def open_twice():
 @testcase
 @kaa.coroutine()
 def play_premature():
-    p = kaa.popcorn.Player()
+    p = new_player()
     p.open(FILES[0])
     try:
         yield p.play()
@@ -93,6 +132,23 @@ def play_normal():
     assert(p.stopped)
 
 
+@testcase
+@kaa.coroutine()
+def play_zap():
+    """
+    Open a new file while playing.  With fast stop, the old child is reaped
+    in the background while the new file opens.
+    """
+    p = yield open_normal()
+    yield p.play()
+    yield kaa.delay(1)
+    t0 = time.time()
+    yield p.open(FILES[1])
+    print '\tzapped in %.3f seconds' % (time.time() - t0)
+    assert(FILES[1] in p.stream.uri)
+    assert(p.opened)
+
+
 @testcase
 @kaa.coroutine()
 def play_induce_backend_failure():
@@ -115,7 +171,588 @@ def play_induce_backend_failure():
         pass
     else:
         raise SystemError('Simulated backend failure did not raise PlayerError as expected')
-        
+
+
+@testcase
+@kaa.coroutine()
+def play_hung_backend():
+    """
+    Freeze the backend child while it's playing and make sure the watchdog
+    kills it and throws an exception to the player InProgress.
+    """
+    p = yield open_normal()
+    yield p.play()
+
+    frozen = []
+    def freeze():
+        print '\tfreezing backend with pid %d' % p._backend._child.pid
+        os.kill(p._backend._child.pid, signal.SIGSTOP)
+        frozen.append(time.time())
+    kaa.OneShotTimer(freeze).start(1)
+
+    try:
+        yield kaa.inprogress(p).timeout(5)
+    except kaa.popcorn.PlayerError:
+        # A stopped child only dies from SIGKILL, the last escalation step.
+        print '\twatchdog recovered after %.2f seconds' % (time.time() - frozen[0])
+        assert(time.time() - frozen[0] < 1.0)
+    else:
+        raise SystemError('Hung backend did not raise PlayerError as expected')
+
+
+@testcase
+@kaa.coroutine()
+def play_hung_in_playback():
+    """
+    Backend child hangs after a second of playback: the error arrives within
+    a second of its last status line (fake mplayer only).
+    """
+    if not FAKE:
+        yield None
+    os.environ['FAKEMPLAYER_HANG'] = 'play:1'
+    try:
+        p = yield open_normal()
+        yield p.play()
+    finally:
+        del os.environ['FAKEMPLAYER_HANG']
+    last = []
+    p.signals['position-changed'].connect(lambda old, new: last.append(time.time()))
+    try:
+        yield kaa.inprogress(p).timeout(5)
+    except kaa.popcorn.PlayerError:
+        print '\twatchdog recovered after %.2f seconds' % (time.time() - last[-1])
+        assert(time.time() - last[-1] < 1.0)
+    else:
+        raise SystemError('Backend hung in playback did not raise PlayerError as expected')
+
+
+@testcase
+@kaa.coroutine()
+def play_concurrent_seek():
+    """
+    Seek two players while the child of the first one is stopped: the second
+    seek must not wait for the first.
+    """
+    players = [ new_player(), new_player() ]
+    for p, f in zip(players, FILES):
+        yield p.open(f)
+        yield p.play()
+    first, second = players
+    pid = first._backend._child.pid
+    os.kill(pid, signal.SIGSTOP)
+    try:
+        ip = first.seek(10)
+        yield second.seek(10).timeout(2)
+        assert(not ip.finished)
+    finally:
+        os.kill(pid, signal.SIGCONT)
+    yield ip
+    for p in players:
+        yield p.stop()
+
+
+@kaa.coroutine()
+def hang_backend(where):
+    """
+    Makes the fake mplayer hang while opening or starting the stream, after
+    its first lines of output, and checks the watchdog fails the operation.
+    """
+    os.environ['FAKEMPLAYER_HANG'] = where
+    try:
+        p = new_player()
+        t0 = time.time()
+        try:
+            yield p.open(FILES[0])
+            yield p.play()
+        except kaa.popcorn.PlayerError:
+            print '\twatchdog recovered after %.2f seconds' % (time.time() - t0)
+        else:
+            raise SystemError('Backend hung at %s did not raise PlayerError as expected' % where)
+        assert(p.stopped)
+    finally:
+        del os.environ['FAKEMPLAYER_HANG']
+
+
+@testcase
+@kaa.coroutine()
+def open_hung_backend():
+    """
+    Backend child hangs opening the file (fake mplayer only).
+    """
+    if FAKE:
+        yield hang_backend('open')
+
+
+@testcase
+@kaa.coroutine()
+def play_hung_at_start():
+    """
+    Backend child hangs before playback starts (fake mplayer only).
+    """
+    if FAKE:
+        yield hang_backend('start')
+
+
+class StandInWindow(object):
+    """
+    Records what the player does to a window, for tests without a display.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.calls = []
+
+    def get_size(self):
+        return self.size
+
+    def resize(self, width, height):
+        self.size = width, height
+        self.calls.append('resize')
+
+    def move(self, x, y):
+        self.calls.append('move')
+
+    def draw_rectangle(self, pos, size, color):
+        self.calls.append('draw')
+
+
+@testcase
+@kaa.coroutine()
+def window_expose_while_resizing():
+    """
+    Expose events during a drag-resize are painted by the one coalesced
+    layout rather than each doing a layout.
+    """
+    p = new_player()
+    yield p.open(FILES[0])
+    outer, inner = StandInWindow((800, 800)), StandInWindow((1, 1))
+    p._window, p._window_inner = outer, inner
+    for size in ((900, 800), (1000, 800), (1100, 800)):
+        outer.size = size
+        p._window_handle_resize(None, size)
+        p._window_handle_expose([((0, 0), size)])
+    assert(not outer.calls and not inner.calls)
+    yield kaa.delay(0.1)
+    # One layout for the final size, both bars painted once.
+    assert(inner.calls == ['resize', 'move'] and outer.calls == ['draw', 'draw'])
+    p._window_handle_expose([((0, 0), (10, 10))])
+    assert(outer.calls.count('draw') == 3)
+    p._window = p._window_inner = None
+    yield p.stop()
+
+
+@testcase
+@kaa.coroutine()
+def window_reuse():
+    """
+    The inner window is created once and kept across zaps, only the video
+    window handed to MPlayer is new for each stream.  Needs kaa.display and
+    an X display.
+    """
+    try:
+        import kaa.display
+    except ImportError:
+        print '\tskipped, kaa.display is not available'
+        yield None
+    if not os.environ.get('DISPLAY'):
+        print '\tskipped, no X display'
+        yield None
+    p = kaa.popcorn.Player()
+    p.window = kaa.display.X11Window(size=(320, 240), title='Popcorn Test')
+    yield p.open(FILES[0])
+    yield p.play()
+    inner, video = p._window_inner, p._window_video
+    assert(inner and video)
+    yield p.open(FILES[1])
+    assert(p._window_inner is inner and p._window_video is None)
+    yield p.play()
+    assert(p._window_inner is inner and p._window_video not in (None, video))
+    yield p.stop()
+    assert(p._window_inner is inner and p._window_video is None)
+
+
+@testcase
+@kaa.coroutine()
+def identify_errors():
+    """
+    Identify a batch in which one file is missing, the child crashes on one
+    and hangs on another: only those fail, with their own errors (fake
+    mplayer only).
+    """
+    if not FAKE:
+        yield None
+    from kaa.popcorn.backends.mplayer.identify import identify_batch
+    os.environ['FAKEMPLAYER_ERROR'] = 'open@missing,crash@crash'
+    os.environ['FAKEMPLAYER_HANG'] = 'open@hang'
+    files = ['a.avi', 'missing.avi', 'b.avi', 'crash.avi', 'c.avi', 'hang.avi', 'd.avi']
+    try:
+        results = yield identify_batch(files)
+    finally:
+        del os.environ['FAKEMPLAYER_ERROR'], os.environ['FAKEMPLAYER_HANG']
+    failed = [ n for n, (info, error) in enumerate(results) if error ]
+    assert(len(results) == len(files) and failed == [1, 3, 5])
+    assert('File not found' in results[1][1])
+    assert('exited' in results[3][1] and 'crash.avi' in results[3][1])
+    assert('hung' in results[5][1] and 'hang.avi' in results[5][1])
+
+
+@testcase
+@kaa.coroutine()
+def play_shm():
+    """
+    Play with shared memory video output and read frames from the ring.
+    """
+    p = new_player()
+    yield p.open(FILES[0], caps=kaa.popcorn.CAP_VO_SHM)
+    yield p.play()
+    yield kaa.delay(1)
+    frames = p.stream.frames
+    seq, timestamp, data = frames.frame()
+    print '\tframe %d: %dx%d %s, %d bytes' % (seq, frames.width, frames.height, frames.fourcc, len(data))
+    assert(seq > 0 and len(data) == frames.size)
+    yield kaa.delay(0.5)
+    assert(frames.seq > seq)
+    yield p.stop()
+
+
+@testcase
+@kaa.coroutine()
+def play_buffering():
+    """
+    Play with a cache and follow the buffering progress.
+    """
+    p = new_player()
+    progress = []
+    p.signals['buffering'].connect(progress.append)
+    # The setting is an integer, -1 (auto) by default, and validated as such.
+    assert(kaa.popcorn.config.cache == -1)
+    p.config.cache = '256'
+    assert(p.config.cache == 256)
+    yield p.open(FILES[0])
+    yield p.play()
+    yield kaa.delay(0.5)
+    print '\tbuffering progress: %s' % ', '.join('%.0f%%' % x for x in progress)
+    assert(progress and progress[-1] == 100)
+    yield p.stop()
+
+
+@testcase
+@kaa.coroutine()
+def play_trickplay():
+    """
+    Scan forward at 8x, then return to normal speed.  Muting done in
+    MPlayer before (e.g. by its key bindings) is kept.
+    """
+    p = new_player()
+    yield p.open(FILES[0])
+    yield p.play()
+    p._backend._slave_cmd('mute 1')
+    pos = p.stream.position
+    p.stream.speed = 8
+    yield kaa.delay(1)
+    print '\tadvanced %.1f seconds in 1 second at 8x' % (p.stream.position - pos)
+    # Seeks are absolute, so the distance is neither short nor overshot.
+    assert(5 < p.stream.position - pos < 10 and p.stream.speed == 8)
+    p.stream.speed = 1
+    yield kaa.delay(0.5)
+    assert(p.stream.speed == 1)
+    # Ask the fake whether it is muted; the answer lands in the same place.
+    p._backend._trickplay_mute = None
+    p._backend._slave_cmd('get_property mute')
+    yield kaa.delay(0.2)
+    assert(p._backend._trickplay_mute is True)
+    yield p.stop()
+
+
+@testcase
+@kaa.coroutine()
+def play_resume():
+    """
+    Stop part-way with a graceful quit, reopen, and resume where playback
+    stopped.  Positions are only kept for local files, so the fake mplayer
+    gets a temporary one.
+    """
+    import json
+    import shutil
+    import tempfile
+    tmp = tempfile.mkdtemp(prefix='popcorn-resume-test-')
+    filename = FILES[0]
+    if FAKE:
+        filename = os.path.join(tmp, 'resume.avi')
+        open(filename, 'w').write('fake')
+    try:
+        p = new_player()
+        p.config.resume.enabled = True
+        p.config.resume.file = os.path.join(tmp, 'resume.json')
+        p.config.resume.skip = 0.5
+        # Wait for MPlayer to quit rather than killing it.
+        p.config.mplayer.faststop.enabled = False
+        yield p.open(filename)
+        yield p.play()
+        yield kaa.delay(1.5)
+        pos = p.stream.position
+        yield p.stop()
+        assert(os.path.isfile(p.config.resume.file))
+        yield p.open(filename)
+        yield p.play()
+        yield kaa.delay(0.2)
+        print '\tstopped at %.1f, resumed at %.1f' % (pos, p.stream.position)
+        assert(p.stream.position >= pos - 0.5)
+        # Opening another stream writes the position right away as well,
+        # rather than after resume.interval.
+        yield kaa.delay(1)
+        pos = p.stream.position
+        yield p.open(FILES[1])
+        stored = json.load(file(p.config.resume.file)).values()
+        assert(stored and stored[0][0] >= pos - 0.5)
+        yield p.stop()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+@testcase
+@kaa.coroutine()
+def play_frame_step_loop():
+    """
+    Step frames while paused, then loop over a segment.
+    """
+    p = new_player()
+    yield p.open(FILES[0])
+    yield p.play()
+    yield kaa.delay(0.5)
+    t0 = time.time()
+    start = p.stream.position
+    pos = yield p.frame_step(5)
+    print '\tstepped 5 frames (%.2f seconds) in %.3f seconds' % (pos - start, time.time() - t0)
+    assert(p.state == kaa.popcorn.STATE_PAUSED and pos > start)
+    try:
+        yield p.frame_step(0)
+    except ValueError:
+        pass
+    else:
+        raise SystemError('frame_step(0) did not raise ValueError as expected')
+    p.loop(1, 2)
+    yield p.play()
+    yield kaa.delay(2.5)
+    assert(p.stream.position < 2.2)
+    # Without an end, the segment runs to the end of the stream.
+    p.loop(1)
+    assert(p._backend._loop == (1.0, p.stream.length))
+    p.loop(None)
+    yield p.stop()
+
+
+@testcase
+@kaa.coroutine()
+def frame_step_child_exit():
+    """
+    The backend child dies while stepping frames: frame_step() fails and
+    no step is left pending.
+    """
+    p = new_player()
+    yield p.open(FILES[0])
+    yield p.play()
+    yield p.pause()
+    pid = p._backend._child.pid
+    # Stopped, so it can't step before it is killed.
+    os.kill(pid, signal.SIGSTOP)
+    ip = p.frame_step(5)
+    os.kill(pid, signal.SIGKILL)
+    try:
+        yield ip
+    except kaa.popcorn.PlayerError:
+        pass
+    else:
+        raise SystemError('frame_step() did not raise PlayerError as expected')
+    assert(p._backend._frame_steps == 0 and p._backend._frame_step_done is None)
+
+
+@testcase
+@kaa.coroutine()
+def play_transcript():
+    """
+    Record a transcript of a session, then have the fake mplayer replay it:
+    the player goes through the same positions again (fake mplayer only).
+    """
+    if not FAKE:
+        yield None
+    import glob
+    import shutil
+    import tempfile
+    from kaa.popcorn.backends.mplayer import transcript
+    tmp = tempfile.mkdtemp(prefix='popcorn-transcript-test-')
+    try:
+        p = new_player()
+        p.config.mplayer.transcript = tmp
+        yield p.open(FILES[0])
+        yield p.play()
+        yield kaa.delay(0.5)
+        yield p.seek(20, kaa.popcorn.SEEK_ABSOLUTE)
+        yield kaa.delay(0.5)
+        pos = p.stream.position
+        # The transcript is complete once all output of the child was read.
+        finished = kaa.inprogress(p._backend._child.signals['finished'])
+        yield p.stop()
+        yield finished
+        filename, = glob.glob(os.path.join(tmp, '*-play.txt.gz'))
+        events = list(transcript.read(filename))
+        assert([ text for ts, kind, text in events if kind == 'I' and 'seek 20' in text ])
+        assert([ text for ts, kind, text in events if kind == 'O' and text.startswith('A:') ])
+
+        os.environ['FAKEMPLAYER_TRANSCRIPT'] = filename
+        try:
+            p = new_player()
+            positions = []
+            p.signals['position-changed'].connect(lambda old, new: positions.append(new))
+            yield p.open(FILES[0])
+            yield p.play()
+            yield kaa.delay(1.5)
+        finally:
+            del os.environ['FAKEMPLAYER_TRANSCRIPT']
+        print '\trecorded up to %.1f, replayed up to %.1f' % (pos, max(positions))
+        assert(positions[0] < 1 and 20 <= max(positions) <= pos)
+        yield p.stop()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+@testcase
+@kaa.coroutine()
+def playlist():
+    """
+    Play the files as a playlist, advancing with next().
+    """
+    p = new_player()
+    pl = kaa.popcorn.Playlist(p, FILES[:2])
+    changed = []
+    pl.signals['changed'].connect(changed.append)
+    # Backends the entries are opened with, chosen while they were parsed.
+    forced = []
+    p_open = p.open
+    p.open = lambda media, caps=None, player=None: forced.append(player) or p_open(media, caps, player)
+    yield pl.play()
+    yield kaa.delay(0.5)
+    t0 = time.time()
+    yield pl.next()
+    print '\tadvanced in %.3f seconds' % (time.time() - t0)
+    assert(changed == [0, 1] and p.state == kaa.popcorn.STATE_PLAYING)
+    assert(forced == ['mplayer', 'mplayer'])
+    yield p.stop()
+
+
+@testcase
+@kaa.coroutine()
+def playlist_graceful_stop():
+    """
+    Switch and stop entries while waiting for MPlayer to quit: no entry
+    may be skipped.
+    """
+    p = new_player()
+    p.config.mplayer.faststop.enabled = False
+    pl = kaa.popcorn.Playlist(p, FILES[:2] + FILES[:1])
+    changed = []
+    pl.signals['changed'].connect(changed.append)
+    yield pl.play()
+    yield kaa.delay(0.5)
+    yield pl.next()
+    yield kaa.delay(0.5)
+    assert(changed == [0, 1] and pl.index == 1)
+    yield pl.stop()
+    yield kaa.delay(0.5)
+    assert(changed == [0, 1] and p.stopped)
+
+
+@testcase
+@kaa.coroutine()
+def null_backend():
+    """
+    Play with the null backend: it goes through the same states and emits
+    the same signals as a backend with a child.
+    """
+    p = new_player()
+    p.config.null.length = 1.0
+    emitted = []
+    record = lambda name: lambda *args: emitted.append(name)
+    for name in ('open', 'start', 'play', 'pause', 'seek', 'stop', 'finished'):
+        p.signals[name].connect(record(name))
+    yield p.open(FILES[0], player='null')
+    assert(p.state == kaa.popcorn.STATE_OPEN and p._backend._player_id == 'null')
+    assert(FILES[0] in p.stream.uri and p.stream.length == 1.0)
+    yield p.play()
+    assert(p.playing)
+    yield p.pause()
+    assert(p.state == kaa.popcorn.STATE_PAUSED)
+    yield p.seek(0.5, kaa.popcorn.SEEK_ABSOLUTE)
+    assert(p.stream.position == 0.5)
+    yield p.resume()
+    # Runs to the end of the stream.
+    yield kaa.inprogress(p)
+    assert(p.stopped)
+    assert(emitted == ['open', 'start', 'play', 'pause', 'seek', 'play', 'finished'])
+    yield p.open(FILES[1], player='null')
+    yield p.play()
+    yield p.stop()
+    assert(p.stopped and emitted[-4:] == ['open', 'start', 'play', 'stop'])
+
+
+@testcase
+@kaa.coroutine()
+def stream_specialized():
+    """
+    The stream properties follow the backend in use, and a reference to
+    them stays valid across a change of backend.
+    """
+    p = new_player()
+    yield p.open(FILES[0])
+    stream = p.stream
+    mplayer = stream.__class__
+    assert(mplayer._backend_class is p._backend.__class__ and 'speed' in mplayer._props)
+    yield p.open(FILES[1], player='null')
+    assert(p.stream is stream and stream.__class__._backend_class is p._backend.__class__)
+    assert(FILES[1] in stream.uri)
+    try:
+        stream.speed
+    except AttributeError:
+        pass
+    else:
+        raise SystemError('null backend stream has a speed property')
+    yield p.open(FILES[0])
+    # Generated once per backend class.
+    assert(stream.__class__ is mplayer)
+    yield p.stop()
+
+
+@testcase
+@kaa.coroutine()
+def proxy_backend_change():
+    """
+    Backend methods proxied by the player are cached, and dropped once a
+    different backend takes over.
+    """
+    p = new_player()
+    yield p.open(FILES[0])
+    mplayer = p._backend
+    reset = p.reset
+    assert(p.__dict__['reset'] == reset and reset.im_self is mplayer)
+    yield p.open(FILES[1], player='null')
+    assert('reset' not in p.__dict__)
+    assert(p._backend is not mplayer and p.reset.im_self is p._backend)
+    yield p.stop()
+
+
+@testcase
+@kaa.coroutine()
+def thumbnails():
+    """
+    Extract evenly spaced frames, then again from the cache.
+    """
+    t0 = time.time()
+    files = yield kaa.popcorn.thumbnail(FILES[0], [10, 20, 30], (160, 0))
+    print '\textracted %d frames in %.3f seconds' % (len(files), time.time() - t0)
+    assert(None not in files and len(set(files)) == 3)
+    t0 = time.time()
+    assert((yield kaa.popcorn.thumbnail(FILES[0], [20], (160, 0))) == files[1:2])
+    print '\tcache hit in %.3f seconds' % (time.time() - t0)
+
 
 @kaa.coroutine()
 def go():
@@ -128,7 +765,7 @@ def go():
     sys.exit(0)
 
 if len(FILES) < 2:
-    print 'Usage: %s file1 file2' % sys.argv[0]
+    print 'Usage: %s [--fake] file1 file2' % sys.argv[0]
     sys.exit(0)
 
 print 'Available backends:', manager.get_all_players()